@@ -1,60 +1,376 @@
+import json
 import sys
 import os.path
+import time
 
 from DMParser import *
+from Instrument import STATS
+from Rendering import OutputSink, RenderCache, wrapText
+from WorldSave import WorldSave
+from WorldWatcher import WorldWatcher
 
 
 class WorldRunner:
     START_NODE = "start"
+    # States kept for undo, the oldest are dropped first
+    HISTORY_SIZE = 10000
 
-    def __init__(self, world, output,printwidth=60):
+    def __init__(self, world, output,printwidth=60,watcher=None):
         self.world = world
         self.output = output
         self.current_node = world.getNode(WorldRunner.START_NODE)
         self.pw = printwidth
+        # Reloads edited world files between commands if given
+        self.watcher = watcher
+        # List collecting output lines instead of printing, see runBatch
+        self.capture = None
+        # Output of a command, sent when it is done
+        self.sink = OutputSink(sys.stdout.write, sys.stdout.flush)
+        # Location descriptions by (node name, world version, print width)
+        self.renders = RenderCache()
+        self.save = None
+        if output is not None:
+            self.save = WorldSave(output)
+            self.restore()
+        # List of (WorldState, node name) after each command changing either
+        self.history = [(self.world.getState(), self.getNodeName())]
+        # Index in history of the current state, entries after it can be redone
+        self.position = 0
 
     def run(self):
+        try:
+            self.start()
+            while True:
+                self.printFormat("What will you do?")
+                self.sink.flush()
+                response = raw_input(">> ")
+                if not self.execute(response):
+                    break
+            self.printFormat("Goodbye!")
+        finally:
+            self.sink.flush()
+
+    def runBatch(self, stream, out=sys.stdout, jsonl=False):
+        '''
+        Runs commands without prompting, skipping blank lines and lines starting with #
+        :param stream: iterable of command lines, i.e. a file or sys.stdin
+        :param out: file receiving output
+        :param jsonl: write one json object per command with its output lines and error
+        :return: number of commands run
+        '''
+        count = 0
+        for line in stream:
+            line = line.strip()
+            if len(line)==0 or line.startswith("#"):
+                continue
+            self.capture = []
+            error = None
+            try:
+                running = self.execute(line)
+            except Exception as e:
+                error = str(e)
+                running = True
+            lines, self.capture = self.capture, None
+            if jsonl:
+                out.write(json.dumps({"command": line, "output": lines, "error": error})+"\n")
+            else:
+                if error is not None:
+                    lines.append("Error: "+error)
+                out.write("".join(l+"\n" for l in lines))
+            count += 1
+            if not running:
+                break
+        out.flush()
+        return count
+
+    def start(self):
         self.printFormat("Welcome Travelers")
         self.describeSetting()
-        while True:
-            self.printFormat("What will you do?")
-            response = raw_input(">> ")
-            response_t = response.split()
-            cmd, args = response_t[0], response_t[1:]
-            if cmd=="exit":
-                # save
-                break
-            elif cmd=="help":
-                self.printHelp()
-            elif cmd=="teleport":
-                self.teleport(args[0])
-            elif cmd=="describe" or cmd=="surroundings":
-                self.describeSetting()
-            elif cmd=="move":
-                self.move(" ".join(args))
-            elif cmd=="set":
-                if len(args)>=2:
-                    self.setAttrib(" ".join(args[:-1]),args[-1])
-                else:
-                    self.printFormat("Error: set [key] [value]")
-            elif cmd=="quests":
-                self.printAttribs()
-            elif cmd=="quest":
-                if len(args)>0:
-                    self.printQuestTransitions(" ".join(args))
-                else:
-                    self.printFormat("Error: quest [questname]")
-            elif cmd=="get":
-                if len(args)>0:
-                    self.printFormat(self.world.getWorldAttr(" ".join(args)))
-                else:
-                    self.printFormat("Error: get [key]")
-        self.printFormat("Goodbye!")
+
+    def execute(self, response):
+        '''
+        Runs a single command
+        :param response: command line as typed
+        :return: False once the session should end
+        '''
+        self.reloadChanges()
+        response_t = response.split()
+        if len(response_t)==0:
+            return True
+        if not STATS.enabled:
+            running = self.dispatch(response_t[0], response_t[1:])
+        else:
+            start = time.time()
+            running = self.dispatch(response_t[0], response_t[1:])
+            STATS.recordCommand(response_t[0], time.time()-start)
+        self.recordHistory()
+        return running
+
+    def dispatch(self, cmd, args):
+        '''
+        :return: False once the session should end
+        '''
+        if cmd=="exit":
+            if self.save is not None:
+                self.save.saveSnapshot(self.world, self.getNodeName())
+            return False
+        elif cmd=="help":
+            self.printHelp()
+        elif cmd=="teleport":
+            self.teleport(args[0])
+        elif cmd=="describe" or cmd=="surroundings":
+            self.describeSetting()
+        elif cmd=="move":
+            self.move(" ".join(args))
+        elif cmd=="set":
+            if len(args)>=2:
+                self.setAttrib(" ".join(args[:-1]),args[-1])
+            else:
+                self.printFormat("Error: set [key] [value]")
+        elif cmd=="quests":
+            self.printAttribs()
+        elif cmd=="quest":
+            if len(args)>1 and args[0]=="reach":
+                self.printQuestReach(args[1:])
+            elif len(args)>0:
+                self.printQuestTransitions(" ".join(args))
+            else:
+                self.printFormat("Error: quest [questname]")
+        elif cmd=="get":
+            if len(args)>0:
+                self.printFormat(str(self.world.getWorldAttr(" ".join(args))))
+            else:
+                self.printFormat("Error: get [key]")
+        elif cmd=="stats":
+            self.printStats(args)
+        elif cmd=="find":
+            if len(args)>0:
+                self.printFind(args)
+            else:
+                self.printFormat("Error: find [terms]")
+        elif cmd=="route":
+            if len(args)>0:
+                self.printRoute(" ".join(args))
+            else:
+                self.printFormat("Error: route [node]")
+        elif cmd=="wait":
+            if len(args)==0 or args[0].isdigit():
+                self.wait(int(args[0]) if len(args)>0 else 1)
+            else:
+                self.printFormat("Error: wait [hours]")
+        elif cmd=="schedule":
+            if len(args)>0:
+                self.printSchedule(args)
+            else:
+                self.printFormat("Error: schedule [character] [hours]")
+        elif cmd=="undo":
+            self.undo()
+        elif cmd=="redo":
+            self.redo()
+        elif cmd=="at":
+            if len(args)>0 and args[0].isdigit():
+                self.travelTo(int(args[0]))
+            else:
+                self.printFormat("Error: at [hour]")
+        return True
+
+    def printFind(self, args):
+        # Words joined by "or" match any of them, otherwise all of them
+        matchall = "or" not in args
+        terms = [a for a in args if a!="or"]
+        results = self.world.find(terms, matchall)
+        if len(results)==0:
+            self.printFormat("Nothing found")
+        for key in results:
+            if key[0]=="node":
+                node = self.world.getNode(key[1])
+                self.printFormat("- place "+key[1]+":")
+                self.printFormat(node.description, " "*4)
+            elif key[0]=="character":
+                self.printFormat("- character "+key[1]+":")
+                # DESC may only be assigned inside an eval
+                vals = self.world.getCharacter(key[1]).getEvalDict(self.world)
+                self.printFormat(vals.get("DESC", ""), " "*4)
+            else:
+                self.printFormat("- quest "+key[1]+" "+str(key[2])+":")
+                self.printFormat(self.world.questlines[key[1]].quest_nodes[key[2]].getDetails(), " "*4)
+
+    def printRoute(self, nodename):
+        if self.world.getNode(nodename) is None:
+            self.printFormat("No such place")
+            return
+        if self.current_node is None:
+            self.printFormat("There are no roads out of the void")
+            return
+        directions = self.world.route(self.current_node.name, nodename)
+        if directions is None:
+            self.printFormat("There is no way to "+nodename+" from here")
+            return
+        self.printFormat("Route to "+nodename+" ("+str(len(directions))+" steps):")
+        node = self.current_node
+        for d in directions:
+            node = node.adjacents[d]
+            self.printFormat("- "+d+":\t"+node.name)
+
+    def wait(self, hours):
+        events = self.world.fastForward(hours, self.getNodeName())
+        self.journal({"hour": self.world.hour})
+        self.printFormat(str(hours)+" hours pass, it is now "+formatHour(self.world.hour))
+        for (hour, event, name, desc) in events:
+            if event=="arrive":
+                self.printFormat("- "+formatHour(hour)+": "+name+" arrives")
+            else:
+                self.printFormat("- "+formatHour(hour)+": "+name+" leaves")
+        self.describeSetting()
+
+    def printSchedule(self, args):
+        hours = 24
+        if len(args)>1 and args[-1].isdigit():
+            hours = int(args[-1])
+            args = args[:-1]
+        name = " ".join(args)
+        character = self.world.getCharacter(name)
+        if character is None:
+            self.printFormat("No such character")
+            return
+        if not character.alive:
+            self.printFormat(name+" is dead")
+            return
+        start = self.world.hour
+        nodes, descs = character.getSchedule(self.world, start, hours)
+        self.printFormat("Schedule of "+name+":")
+        first = 0
+        for i in range(1, hours+1):
+            if i==hours or nodes[i]!=nodes[first] or descs[i]!=descs[first]:
+                self.printFormat("- "+formatHour(start+first)+" to "+formatHour(start+i)+": "+nodes[first])
+                self.printFormat(descs[first], " "*4)
+                first = i
+
+    def printStats(self, args):
+        if len(args)>0 and args[0]=="on":
+            STATS.enabled = True
+        elif len(args)>0 and args[0]=="off":
+            STATS.enabled = False
+        elif len(args)>0 and args[0]=="reset":
+            STATS.reset()
+        elif len(args)>1 and args[0]=="export":
+            STATS.export(" ".join(args[1:]))
+            self.printFormat("Exported to "+" ".join(args[1:]))
+        elif len(args)>0:
+            self.printFormat("Error: stats [on|off|reset|export [file]]")
+        elif not STATS.enabled:
+            self.printFormat("Instrumentation is off, enable with: stats on")
+        else:
+            for line in STATS.getReport():
+                self.write(line)
+
+    def recordHistory(self):
+        '''
+        Adds the current state to the history if a command changed it, in O(1)
+        '''
+        state, nodename = self.history[self.position]
+        if state.sameAs(self.world.getState()) and nodename==self.getNodeName():
+            return
+        del self.history[self.position+1:]
+        self.history.append((self.world.getState(), self.getNodeName()))
+        if len(self.history)>WorldRunner.HISTORY_SIZE:
+            del self.history[0]
+        self.position = len(self.history)-1
+
+    def undo(self):
+        if self.position==0:
+            self.printFormat("Nothing to undo")
+            return
+        self.position -= 1
+        self.travel(*self.history[self.position])
+
+    def redo(self):
+        if self.position==len(self.history)-1:
+            self.printFormat("Nothing to redo")
+            return
+        self.position += 1
+        self.travel(*self.history[self.position])
+
+    def travelTo(self, hour):
+        '''
+        Returns to the state at an earlier hour, as a new change which can be undone
+        '''
+        if hour>self.world.hour:
+            self.printFormat("Hour "+str(hour)+" has not happened yet, use wait")
+            return
+        # Quests only change within an hour, so the last state at or before hour held
+        for state, nodename in reversed(self.history[:self.position+1]):
+            if state.hour<=hour:
+                self.travel(state.atHour(hour), nodename)
+                return
+        self.printFormat("No state recorded at "+formatHour(hour))
+
+    def travel(self, state, nodename):
+        '''
+        Sets the world and location to an earlier state, journaling the differences
+        '''
+        quests, characters = self.world.setState(state)
+        self.current_node = self.world.getNode(nodename) if nodename is not None else None
+        self.journal({"hour": self.world.hour, "node": nodename})
+        self.printFormat("It is now "+formatHour(self.world.hour))
+        for (name, val) in quests:
+            self.journal({"quest": name, "val": val})
+            self.printFormat("- "+name+" -> "+str(val))
+        for (name, alive) in characters:
+            if alive:
+                self.journal({"alive": name})
+                self.printFormat("- "+name+" lives")
+            else:
+                self.journal({"dead": name})
+                self.printFormat("- "+name+" dies")
+        self.describeSetting()
+
+    def restore(self):
+        if not self.save.exists():
+            return
+        nodename = self.save.load(self.world)
+        if nodename is not None:
+            self.current_node = self.world.getNode(nodename)
+
+    def journal(self, entry):
+        '''
+        Records a state change so it survives a restart
+        '''
+        if self.save is None:
+            return
+        self.save.record(entry)
+        if self.save.needsCompaction():
+            self.save.saveSnapshot(self.world, self.getNodeName())
+
+    def getNodeName(self):
+        if self.current_node is None:
+            return None
+        return self.current_node.name
+
+    def reloadChanges(self):
+        if self.watcher is None:
+            return
+        reloaded = self.watcher.poll()
+        for f in reloaded:
+            self.printFormat("[!] Reloaded "+f)
+        if len(reloaded)>0:
+            # Keys hold the old world version so would never be hit again, free them now
+            self.renders.clear()
+        if len(reloaded)>0 and self.current_node is not None:
+            # Lazy worlds parse edited nodes again, so the old object is out of date
+            nodename = self.current_node.name
+            self.current_node = self.world.getNode(nodename)
+            if self.current_node is None:
+                self.current_node = self.world.getNode(WorldRunner.START_NODE)
+                self.printFormat("[!] "+nodename+" was removed, moving to "+str(self.getNodeName()))
+                self.journal({"node": self.getNodeName()})
 
     def setAttrib(self,key,value):
         try:
             self.printFormat(key+" -> "+value)
             self.world.addQuestState(key,int(value))
+            if key in self.world.questlines:
+                self.journal({"quest": key, "val": self.world.questlines[key].currValue()})
         except ValueError:
             self.printFormat("Error: Quest value must be integer")
 
@@ -78,28 +394,70 @@ class WorldRunner:
         else:
             self.printFormat("No such quest")
 
+    def printQuestReach(self, args):
+        val = None
+        questname = " ".join(args)
+        if questname not in self.world.questlines and len(args)>1:
+            questname = " ".join(args[:-1])
+            try:
+                val = int(args[-1])
+            except ValueError:
+                self.printFormat("Error: quest reach [questname] [value]")
+                return
+        if questname not in self.world.questlines:
+            self.printFormat("No such quest")
+            return
+        ql = self.world.questlines[questname]
+        if val is not None:
+            if ql.canReach(val):
+                self.printFormat(questname+" can still reach "+str(val))
+            else:
+                self.printFormat(questname+" can no longer reach "+str(val))
+            return
+        self.printFormat("Reachable from "+str(ql.currValue())+": "+
+                         ", ".join(str(v) for v in ql.reachableFrom()))
+        unreachable, terminals, missing = ql.getReachReport()
+        self.printFormat("Unreachable from start: "+", ".join(str(v) for v in unreachable))
+        self.printFormat("Terminal: "+", ".join(str(v) for v in terminals))
+        for (v, t) in missing:
+            self.printFormat("[!] "+str(v)+" has a transition to missing value "+str(t))
+
     def describeSetting(self):
         if self.current_node is None:
             self.printFormat("You are in the void, the endless abyss taunts you")
             self.printFormat("\tyour insanity only grows here")
         else:
-            print("="*self.pw)
-            self.printFormat("You are in "+self.current_node.name)
-            self.printFormat(self.current_node.description)
-            print("-"*self.pw)
-            active_characters = self.current_node.getActiveCharacters(self.world)
-            for (c,name,desc) in active_characters:
-                self.printFormat("- "+name)
-                self.printFormat(desc," "*4)
-            print("-"*self.pw)
-            self.printFormat("Directions:")
-            for k in self.current_node.adjacents:
-                self.printFormat("- "+str(k)+":\t"+self.current_node.adjacents[k].name)
-            print("="*self.pw)
+            key = (self.current_node.name, self.world.version, self.pw)
+            pieces = self.renders.get(key)
+            if pieces is None:
+                pieces = self.renderSetting(self.current_node)
+                self.renders.put(key, pieces)
+            for s in pieces:
+                self.write(s)
+
+    def renderSetting(self, node):
+        '''
+        :return: tuple of the strings describing node, each written separately
+        '''
+        pieces = ["="*self.pw,
+                  wrapText("You are in "+node.name, self.pw),
+                  wrapText(node.description, self.pw),
+                  "-"*self.pw]
+        active_characters = node.getActiveCharacters(self.world)
+        for (c,name,desc) in active_characters:
+            pieces.append(wrapText("- "+name, self.pw))
+            pieces.append(wrapText(desc, self.pw, " "*4))
+        pieces.append("-"*self.pw)
+        pieces.append(wrapText("Directions:", self.pw))
+        for k in node.adjacents:
+            pieces.append(wrapText("- "+str(k)+":\t"+node.adjacents[k].name, self.pw))
+        pieces.append("="*self.pw)
+        return tuple(pieces)
 
     def move(self,direction):
         if direction in self.current_node.adjacents:
             self.current_node = self.current_node.adjacents[direction]
+            self.journal({"node": self.getNodeName()})
             self.describeSetting()
         else:
             self.printFormat("Not a valid direction")
@@ -107,6 +465,7 @@ class WorldRunner:
     def teleport(self,nodename):
         self.printFormat("WHOOSH!")
         self.current_node = self.world.getNode(nodename)
+        self.journal({"node": self.getNodeName()})
         self.describeSetting()
 
     def printHelp(self):
@@ -114,31 +473,55 @@ class WorldRunner:
         self.printFormat("teleport [name] : set location to node")
         self.printFormat("describe : describe settings")
         self.printFormat("quest [name] : give details on a particular questline")
+        self.printFormat("quest reach [name] [value] : whether a quest can still reach a value, or what it can reach")
         self.printFormat("quests : list all quests")
         self.printFormat("get [name] : get value of world attribute / questline")
         self.printFormat("set [name] : set value of world attribute / questline")
+        self.printFormat("stats [on|off|reset|export [file]] : show slowest characters, files and commands")
+        self.printFormat("find [words] : search descriptions, words separated by or match any")
+        self.printFormat("route [name] : directions from here to a node")
+        self.printFormat("wait [hours] : let time pass, reporting who comes and goes")
+        self.printFormat("schedule [character] [hours] : where a character will be, quests unchanged")
+        self.printFormat("undo : revert the last command changing the time, quests or location")
+        self.printFormat("redo : reapply a reverted command")
+        self.printFormat("at [hour] : return to the state at an earlier hour, undo to come back")
         self.printFormat("exit : close client")
 
     def printFormat(self,s,indent=""):
-        s_t = s.split()
-        new_s = ""
-        curr_line = ""
-        for s in s_t:
-            if len(curr_line + s)>self.pw:
-                if len(new_s)>0:
-                    new_s += "\n"
-                new_s += indent + curr_line
-                curr_line = ""
-            curr_line += " " + s
-        if len(curr_line)>0:
-            if len(new_s)>0:
-                new_s += "\n"
-            new_s += indent + curr_line
-        print(new_s)
+        self.write(wrapText(s, self.pw, indent))
+
+    def write(self, s):
+        '''
+        Outputs a line, sent with the rest of the command's output by sink.flush
+        '''
+        if self.capture is not None:
+            self.capture.append(s)
+        else:
+            self.sink.write(s)
+
+def formatHour(hour):
+    return "day %d %02d:00" % (hour/24, hour%24)
+
+def parseOptions(argv):
+    '''
+    Splits --key=value options from positional arguments
+    :return: (positional arguments, {key: value})
+    '''
+    args = []
+    options = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            options[key] = value
+        else:
+            args.append(arg)
+    return args, options
 
 if __name__ == "__main__":
+    sys.argv, options = parseOptions(sys.argv)
     if len(sys.argv)!=3:
-        print("CLI usage: python AutoDM.py [worldpath] [outputpath]")
+        print("CLI usage: python AutoDM.py [worldpath] [outputpath] [--processes=N] [--no-cache] [--clear-cache] [--no-reload] [--stats]")
+        print("          [--batch=SCRIPT|-] [--json] [--lazy]")
     if len(sys.argv)==3:
         filename = sys.argv[-2]
         outputpath = sys.argv[-1]
@@ -163,7 +546,24 @@ if __name__ == "__main__":
                 break
             print("Invalid path")
 
-    p = WorldParser(filename)
+    STATS.enabled = "stats" in options
+    cachedir = None
+    if "no-cache" not in options:
+        cachedir = os.path.join(outputpath, "parsecache")
+    p = WorldParser(filename, processes=int(options.get("processes", 1)), cachedir=cachedir,
+                    lazy="lazy" in options)
+    if "clear-cache" in options and p.cache is not None:
+        p.cache.clear()
     w = p.parse()
-    wr = WorldRunner(w, outputpath)
-    wr.run()
+    watcher = None
+    if "no-reload" not in options:
+        watcher = WorldWatcher(p, w)
+    wr = WorldRunner(w, outputpath, watcher=watcher)
+    if "batch" in options:
+        if options["batch"] in ["", "-"]:
+            wr.runBatch(sys.stdin, jsonl="json" in options)
+        else:
+            with open(options["batch"]) as script:
+                wr.runBatch(script, jsonl="json" in options)
+    else:
+        wr.run()
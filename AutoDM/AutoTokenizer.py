@@ -1,4 +1,11 @@
+import mmap
+import os
+import re
+
+
 class Tokenizer(object):
+    __slots__ = ("tokenizer", "next")
+
     def __init__(self, tokenizer):
         self.tokenizer = tokenizer
         try:
@@ -18,20 +25,89 @@ class Tokenizer(object):
         return self.next is not None
 
 
-class FileTokenizer(Tokenizer):
+class ListTokenizer(Tokenizer):
+    __slots__ = ("tokens", "index")
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.index = 0
+        if len(tokens)>0:
+            self.next = tokens[0]
+        else:
+            self.next = None
+    def consume(self):
+        temp = self.next
+        self.index += 1
+        if self.index<len(self.tokens):
+            self.next = self.tokens[self.index]
+        else:
+            self.next = None
+        return temp
+
+
+class ChunkTokenizer(ListTokenizer):
+    __slots__ = ("chunks",)
+
+    def __init__(self, chunks):
+        '''
+        Tokens of consecutive pieces of a file, each tokenized when the last is consumed
+        :param chunks: iterable of token lists
+        '''
+        self.chunks = iter(chunks)
+        ListTokenizer.__init__(self, [])
+        self.next = self.refill()
+    def consume(self):
+        temp = self.next
+        self.index += 1
+        if self.index<len(self.tokens):
+            self.next = self.tokens[self.index]
+        else:
+            self.next = self.refill()
+        return temp
+    def refill(self):
+        for tokens in self.chunks:
+            if len(tokens)>0:
+                self.tokens = tokens
+                self.index = 0
+                return tokens[0]
+        self.tokens = []
+        self.index = 0
+        return None
+
+
+class FileTokenizer(ListTokenizer):
+    __slots__ = ()
+
     def __init__(self,filename):
-        tok = tokenizeFile(filename)
-        Tokenizer.__init__(self,tok)
+        if BULK_TOKENIZER:
+            tokens = scanFile(filename)
+        else:
+            tokens = list(tokenizeFile(filename))
+        ListTokenizer.__init__(self,tokens)
+
 
+class TextTokenizer(ListTokenizer):
+    __slots__ = ()
 
-class TextTokenizer(Tokenizer):
     def __init__(self,s):
-        tok = tokenizeString(s)
-        Tokenizer.__init__(self,tok)
+        if BULK_TOKENIZER:
+            tokens = scanBuffer(s, splitlines=False)
+        else:
+            tokens = list(tokenizeString(s))
+        ListTokenizer.__init__(self,tokens)
 
 
 valid_id = "abcdefghijklmnopqrstuvwxyz1234567890_"
 
+# Input is scanned whole by scanBuffer, set False to use the tokenizing generators
+BULK_TOKENIZER = True
+# Quoted text, id, comment, whitespace or a single other character
+TOKEN_RE = re.compile(r'"([^"]*)"?|([A-Za-z0-9_]+)|(#[^\n]*)|\s+|(.)', re.DOTALL)
+# As TOKEN_RE, skipping whitespace and comments within the match so findall can be used
+LINE_TOKEN_RE = re.compile(r'\s*(?:"([^"]*)"?|([A-Za-z0-9_]+)|#[^\n]*|(\S))')
+# Lines of quoted text, keeping the newline
+LINE_RE = re.compile(r'[^\n]*\n|[^\n]+')
+
 def tokenizeFile(filename):
     '''
     Tokenizes file into ids, quotes and non-word characters
@@ -105,3 +181,101 @@ def tokenizeString(line):
             acc += c
     if len(acc)>0:
         yield acc
+
+
+def scanFile(filename):
+    '''
+    Tokenizes file in one pass over its memory mapped contents, matches tokenizeFile
+    :param filename: file to tokenize
+    :return: list of tokens
+    '''
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size==0:
+            return []
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return scanBuffer(buf)
+        finally:
+            buf.close()
+
+
+def scanBuffer(buf, splitlines=True):
+    '''
+    Tokenizes a buffer into ids, quotes and non-word characters
+    :param buf: string or buffer to tokenize
+    :param splitlines: end tokens at newlines and comments at line ends like tokenizeFile,
+    otherwise a comment ends the buffer like tokenizeString
+    :return: list of tokens
+    '''
+    tokens = []
+    append = tokens.append
+    if splitlines:
+        # Comments and whitespace leave every group empty, as does an empty quote
+        for text, ident, other in LINE_TOKEN_RE.findall(buf):
+            if ident:
+                append(ident)
+            elif other:
+                append(other)
+            elif text:
+                if "\n" in text:
+                    tokens.extend(LINE_RE.findall(text))
+                else:
+                    append(text)
+        return tokens
+    for m in TOKEN_RE.finditer(buf):
+        kind = m.lastindex
+        if kind==2 or kind==4:
+            append(m.group(kind))
+        elif kind==1:
+            if len(m.group(1))>0:
+                append(m.group(1))
+        elif kind==3:
+            break
+    return tokens
+
+
+# Quotes, comments and braces, enough to find where top level objects start and end
+OBJECT_SCAN_RE = re.compile(r'"[^"]*"?|#[^\n]*|[{}]')
+
+
+def scanObjectOffsets(filename):
+    '''
+    Finds the top level objects of a file without tokenizing their contents
+    :param filename: file to scan
+    :return: list of (name, start, end) with the byte offsets of the object's name and
+    just past its closing brace
+    '''
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size==0:
+            return []
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return scanBufferOffsets(buf)
+        finally:
+            buf.close()
+
+
+def scanBufferOffsets(buf):
+    objects = []
+    depth = 0
+    # End of the previous object, the next name is the last token after it
+    last = 0
+    start = name = None
+    for m in OBJECT_SCAN_RE.finditer(buf):
+        c = m.group()
+        if c=="{":
+            if depth==0:
+                for t in LINE_TOKEN_RE.finditer(buf, last, m.start()):
+                    kind = t.lastindex
+                    if kind is not None:
+                        # Quoted names start at their opening quote
+                        start, name = t.start(kind)-(kind==1), t.group(kind)
+            depth += 1
+        elif c=="}":
+            depth -= 1
+            if depth==0:
+                objects.append((name, start, m.end()))
+                last = m.end()
+    return objects
@@ -0,0 +1,275 @@
+'''
+Timing harness for world parsing and evaluation
+'''
+import datetime
+import gc
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import AutoTokenizer
+from AutoDM import WorldRunner, parseOptions
+from DMParser import *
+from WorldGenerator import WorldGenerator
+
+SIZES = {"small": {"nodes": 100, "characters": 200, "quests": 10},
+         "medium": {"nodes": 1000, "characters": 2000, "quests": 50},
+         "large": {"nodes": 10000, "characters": 20000, "quests": 200}}
+DEFAULT_RESULTS = "bench_results.jsonl"
+
+
+def timeRunEvals(world, chars, hours):
+    '''
+    Runs the evals of every character for each hour, bypassing timetables and caches
+    :return: seconds taken
+    '''
+    start = time.time()
+    for h in range(hours):
+        world.addHour(1)
+        for c in chars:
+            c.runEvals(world)
+    return time.time() - start
+
+
+def benchCompiledEvals(characters=2000, nodes=100, hours=48):
+    '''
+    Compares compiled character evaluation against the interpreter
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        WorldGenerator(nodes=nodes, characters=characters, rerun=0.5).generate(path)
+        w = WorldParser(path).parse()
+        chars = list(w.characters.values())
+
+        # Conditions are evaluated per character in both, so only compilation differs
+        for c in chars:
+            c.markSharedConditions(False)
+            c.compiled = compileWorldEvals(c.worldevals, c["NAME"])
+        compiled = timeRunEvals(w, chars, hours)
+        for c in chars:
+            c.compiled = None
+        interpreted = timeRunEvals(w, chars, hours)
+        for c in chars:
+            c.compileEvals()
+
+        print("Characters: %d, nodes: %d, hours: %d" % (characters, nodes, hours))
+        print("Interpreted: %.3fs" % interpreted)
+        print("Compiled:    %.3fs" % compiled)
+        print("Speedup:     %.2fx" % (interpreted/max(compiled, 1e-9)))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchTokenizer(characters=20000):
+    '''
+    Compares parse throughput of the bulk scanner against the tokenizing generator
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        WorldGenerator(nodes=100, characters=characters, files=1).generate(path)
+        filename = os.path.join(path, "characters", "characters_0.txt")
+        megabytes = os.path.getsize(filename)/(1024.0*1024.0)
+        parser = DMObjectParser()
+        results = []
+        for bulk in [False, True]:
+            AutoTokenizer.BULK_TOKENIZER = bulk
+            start = time.time()
+            tok = FileTokenizer(filename)
+            tokenized = time.time() - start
+            list(parser.consumeDMObjects(tok))
+            parsed = time.time() - start
+            results.append((tokenized, parsed))
+        AutoTokenizer.BULK_TOKENIZER = True
+
+        print("File size: %.2fMB" % megabytes)
+        for label, (tokenized, parsed) in zip(["Generator:", "Bulk:     "], results):
+            print("%s tokenize %.3fs (%.2fMB/s), parse %.3fs (%.2fMB/s)" %
+                  (label, tokenized, megabytes/max(tokenized, 1e-9), parsed, megabytes/max(parsed, 1e-9)))
+    finally:
+        shutil.rmtree(path)
+
+
+def getResidentMemory():
+    '''
+    :return: resident set size in megabytes, the peak where the current size is unavailable
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*resource.getpagesize()/(1024.0*1024.0)
+    except IOError:
+        # Kilobytes on linux, bytes on OSX
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+
+def getDeepSize(root):
+    '''
+    :return: bytes taken by root and every object reachable from it, excluding modules,
+    classes and module globals
+    '''
+    skip = set(id(m.__dict__) for m in sys.modules.values() if m is not None)
+    seen = set()
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or id(obj) in skip or isinstance(obj, (type, types.ModuleType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+def benchMemory(nodes=100000, characters=10000):
+    '''
+    Measures the memory taken by a parsed world
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        WorldGenerator(nodes=nodes, characters=characters, quests=100, files=20).generate(path)
+        gc.collect()
+        before = getResidentMemory()
+        start = time.time()
+        w = WorldParser(path).parse()
+        seconds = time.time() - start
+        gc.collect()
+        after = getResidentMemory()
+        print("Nodes: %d, characters: %d" % (len(w.nodes), len(w.characters)))
+        print("Parse: %.3fs" % seconds)
+        print("Resident: %.1fMB (peak %.1fMB)" %
+              (after-before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0))
+        print("World objects: %.1fMB" % (getDeepSize(w)/(1024.0*1024.0)))
+    finally:
+        shutil.rmtree(path)
+
+
+def benchWorld(params, repeats=200, seed=0):
+    '''
+    Times the stages of loading and playing a generated world
+    :param params: WorldGenerator keyword arguments
+    :param repeats: number of describes, moves and quest changes
+    :return: {stage: seconds}
+    '''
+    path = tempfile.mkdtemp()
+    try:
+        WorldGenerator(seed=seed, **params).generate(path)
+        timings = {}
+        parser = WorldParser(path)
+        start = time.time()
+        world = parser.parse()
+        timings["parse"] = time.time() - start
+
+        runner = WorldRunner(world, None)
+        runner.capture = []
+        rand = random.Random(seed)
+        nodenames = sorted(world.nodes)
+        start = time.time()
+        for i in range(repeats):
+            runner.current_node = world.nodes[rand.choice(nodenames)]
+            world.addHour(rand.randint(1, 5))
+            runner.describeSetting()
+            runner.capture = []
+        timings["describe"] = time.time() - start
+
+        runner.current_node = world.getNode(WorldRunner.START_NODE)
+        start = time.time()
+        for i in range(repeats):
+            directions = sorted(runner.current_node.adjacents)
+            runner.move(rand.choice(directions))
+            runner.capture = []
+        timings["move"] = time.time() - start
+
+        questnames = sorted(world.questlines)
+        start = time.time()
+        for i in range(repeats):
+            ql = world.questlines[rand.choice(questnames)]
+            transitions = sorted(ql.curr_node.transitions)
+            if len(transitions)>0:
+                world.addQuestState(ql.name, rand.choice(transitions))
+            else:
+                ql.force(min(ql.quest_nodes))
+            runner.describeSetting()
+            runner.capture = []
+        timings["quest"] = time.time() - start
+        return timings
+    finally:
+        shutil.rmtree(path)
+
+
+def getRevision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runSuite(sizes, resultfile=DEFAULT_RESULTS):
+    '''
+    Benchmarks each size, printing timings and appending them to resultfile
+    :param sizes: names of entries in SIZES
+    '''
+    revision = getRevision()
+    for size in sizes:
+        timings = benchWorld(SIZES[size])
+        print(size+": "+", ".join("%s %.3fs" % (k, timings[k]) for k in sorted(timings)))
+        record = {"date": datetime.datetime.now().isoformat(),
+                  "revision": revision,
+                  "python": sys.version.split()[0],
+                  "size": size,
+                  "params": SIZES[size],
+                  "timings": timings}
+        with open(resultfile, "a") as f:
+            f.write(json.dumps(record)+"\n")
+
+
+def compareResults(resultfile=DEFAULT_RESULTS):
+    '''
+    Prints the last two recorded runs of each size side by side
+    '''
+    runs = {}
+    with open(resultfile) as f:
+        for line in f:
+            record = json.loads(line)
+            runs.setdefault(record["size"], []).append(record)
+    for size in sorted(runs):
+        if len(runs[size])<2:
+            print(size+": only one run recorded")
+            continue
+        old, new = runs[size][-2], runs[size][-1]
+        print("%s: %s -> %s" % (size, old["revision"], new["revision"]))
+        for stage in sorted(new["timings"]):
+            if stage in old["timings"]:
+                before, after = old["timings"][stage], new["timings"][stage]
+                print("    %-10s %8.3fs %8.3fs %6.2fx" % (stage, before, after, before/max(after, 1e-9)))
+
+
+if __name__ == "__main__":
+    args, options = parseOptions(sys.argv)
+    resultfile = options.get("results", DEFAULT_RESULTS)
+    if len(args)<2:
+        print("CLI usage: python Benchmark.py suite [--sizes=small,medium,large] [--results=FILE]")
+        print("           python Benchmark.py compare [--results=FILE]")
+        print("           python Benchmark.py evals|tokenizer [--characters=N]")
+        print("           python Benchmark.py memory [--nodes=N] [--characters=N]")
+    elif args[1]=="suite":
+        runSuite(options.get("sizes", "small,medium").split(","), resultfile)
+    elif args[1]=="compare":
+        compareResults(resultfile)
+    elif args[1]=="evals":
+        benchCompiledEvals(characters=int(options.get("characters", 2000)))
+    elif args[1]=="tokenizer":
+        benchTokenizer(characters=int(options.get("characters", 20000)))
+    elif args[1]=="memory":
+        benchMemory(nodes=int(options.get("nodes", 100000)),
+                    characters=int(options.get("characters", 10000)))
+    else:
+        print("[!] Unknown benchmark "+args[1])
@@ -1,60 +1,393 @@
 '''
 Contains all classes managing characters
 '''
+import time
+
 from DMEval import *
+from Instrument import STATS
+from World import World
+
+# Number of resolved world states remembered per character
+EVAL_CACHE_SIZE = 4
+# Passes over every hour at once before schedules are evaluated hour by hour instead
+ARRAY_MAX_PASSES = 16
+# Hours after which both hour and weekday repeat
+WEEK_HOURS = 168
+# Attributes which only depend on the hour of the week
+WEEKLY_ATTRS = frozenset(["hour", "weekday"])
 
 
 # noinspection PyPep8Naming
 class WorldCharacter(object):
+    __slots__ = ("characteristics", "worldevals", "nodes", "nodeset", "alive", "compiled",
+                 "evalcache", "timetable", "thresholds", "cycles")
+
     def __init__(self,name):
-        self.characteristics = {"NAME": name}
+        self.characteristics = {"NAME": intern(name)}
         self.worldevals = []
-        # List of all nodes this character may appear in
+        # List of all nodes this character may appear in, and the same as a set
         self.nodes = []
+        self.nodeset = set()
         self.alive = True
+        # Compiled form of worldevals, None falls back to interpreting them
+        self.compiled = None
+        # {world version: eval dict}
+        self.evalcache = {}
+        # (entries, slots) for characters only reading weekly attributes, False for
+        # others and None until first needed
+        self.timetable = None
+        # {time attribute: values} around which evals may change, False if unknown
+        self.thresholds = None
+        # Cycles of local values already warned about
+        self.cycles = set()
 
     def addCharacteristic(self, name, value):
-        if name.upper()=="NODE" and value not in self.nodes:
-            self.nodes.append(value)
-        self.characteristics[name] = value
+        if name.upper()=="NODE":
+            value = intern(value)
+            self.addNode(value)
+        self.characteristics[intern(name)] = value
+        self.invalidate()
+        if self.worldevals:
+            self.markSharedConditions(False)
 
     def addWorldEval(self, worldeval):
         self.worldevals.append(worldeval)
+        self.compiled = None
+        self.invalidate()
+        self.markSharedConditions(False)
         for n in worldeval.getNodes():
-            if n not in self.nodes:
-                self.nodes.append(n)
+            self.addNode(n)
+
+    def addNode(self, nodename):
+        if nodename not in self.nodeset:
+            self.nodeset.add(nodename)
+            self.nodes.append(nodename)
+
+    def getReads(self):
+        '''
+        :return: set of world attribute names the evals may read
+        '''
+        reads = set()
+        for we in self.worldevals:
+            reads.update(we.getReads())
+        return reads.difference(self.characteristics)
+
+    def getTexts(self):
+        '''
+        :return: name and every description the character may have
+        '''
+        texts = [self.characteristics["NAME"]]
+        if "DESC" in self.characteristics:
+            texts.append(self.characteristics["DESC"])
+        for we in self.worldevals:
+            texts += we.getAssigned("DESC")
+        return texts
 
     def linkPossibleNodes(self, world):
         for n in self.nodes:
-            node = world.getNode(n)
+            if n not in world.nodes:
+                print("[!] Could not find node "+n)
+                continue
+            # Lazily parsed nodes pick up their characters when loaded
+            node = world.getLoadedNode(n)
             if node:
                 node.addCharacter(self)
-            else:
-                print("[!] Could not find node "+n)
+
+    def markSharedConditions(self, share=True):
+        '''
+        Lets conditions reading no local attributes share their results between characters
+        :param share: False to evaluate every condition locally, until compileEvals
+        '''
+        local = None
+        if share:
+            local = set(self.characteristics)
+            for we in self.worldevals:
+                local.update(we.getAssignedNames())
+        for we in self.worldevals:
+            we.markShared(local)
+
+    def compileEvals(self):
+        '''
+        Compiles worldevals into a single python function, keeps interpreter on failure
+        '''
+        self.compiled = None
+        self.invalidate()
+        self.markSharedConditions()
+        if not COMPILE_EVALS:
+            return
+        try:
+            self.compiled = compileWorldEvals(self.worldevals, self.characteristics["NAME"])
+        except Exception as e:
+            print("[!] Could not compile character "+self.characteristics["NAME"]+": "+str(e))
 
     def getEvalDict(self, world):
+        '''
+        Resolves characteristics for the current world state, cached per version of the
+        world attributes the character reads
+        :param world: World to evaluate in
+        :return: dict of characteristics, shared between calls so must not be modified
+        '''
+        version = world.getEvalVersion(self)
+        vals = self.evalcache.get(version)
+        if vals is None:
+            vals = self.computeEvalDict(world)
+            if len(self.evalcache)>=EVAL_CACHE_SIZE:
+                # Versions only grow, so the smallest is the oldest
+                del self.evalcache[min(self.evalcache)]
+            self.evalcache[version] = vals
+        return vals
+
+    def computeEvalDict(self, world):
+        if not STATS.enabled:
+            return self.runEvals(world)[0]
+        start = time.time()
+        vals, iters = self.runEvals(world)
+        STATS.recordEval(self.characteristics["NAME"], time.time()-start, iters)
+        return vals
+
+    def runEvals(self, world):
+        '''
+        Evaluates until a pass finishes without RERUN
+        :return: (eval dict, number of passes)
+        '''
+        if self.compiled is not None:
+            vals = self.characteristics.copy()
+            return self.runToFixpoint(world, vals, lambda: self.compiled(vals, world))
         wd = WorldDict(world, self.characteristics)
-        running = True
-        iters = 0
-        while running and iters<MAX_ITERS:
-            running = False
-            iters += 1
+        return self.runToFixpoint(world, wd.vals, lambda: self.runPass(wd))
+
+    def runPass(self, wd):
+        '''
+        :return: True if RERUN was hit
+        '''
+        try:
+            for we in self.worldevals:
+                we.evaluate(wd)
+        except RerunException:
+            return True
+        return False
+
+    def runToFixpoint(self, world, vals, step):
+        '''
+        Repeats passes until one finishes without RERUN. A pass only depends on the local
+        values it starts from, so reaching values seen before means the passes cycle, in
+        which case the values MAX_ITERS passes would have ended on are taken from the cycle
+        :param vals: local values, modified by step
+        :param step: function running one pass over vals -> True if RERUN was hit
+        :return: (eval dict, number of passes run)
+        '''
+        if not step():
+            return vals, 1
+        # states[i] holds the local values after i passes
+        states = [frozenset(self.characteristics.items())]
+        seen = {states[0]: 0}
+        while True:
+            passes = len(states)
+            state = frozenset(vals.items())
+            if state in seen:
+                first = seen[state]
+                final = states[first+(MAX_ITERS-first)%(passes-first)]
+                self.reportCycle(world, states[first:])
+                return dict(final), passes
+            if passes>=MAX_ITERS:
+                print("[!] Character iteration limit reached.")
+                STATS.count("iteration limit")
+                return vals, passes
+            seen[state] = passes
+            states.append(state)
+            if not step():
+                return vals, passes+1
+
+    def reportCycle(self, world, states):
+        '''
+        Warns once per distinct cycle about the attributes the passes keep changing
+        :param states: local values of each pass start in the cycle
+        '''
+        STATS.count("eval cycles")
+        cycle = frozenset(states)
+        if cycle in self.cycles:
+            return
+        self.cycles.add(cycle)
+        attrs = set()
+        for state in states:
+            attrs.update(k for k, v in state.symmetric_difference(states[0]))
+        fired, rerun = self.getFiredEvals(world, dict(states[0]))
+        if attrs:
+            cause = "cycles through "+str(len(states))+" states of "+", ".join(sorted(attrs))
+        else:
+            cause = "reruns without changing anything"
+        print("[!] Character "+self.characteristics["NAME"]+" "+cause+", firing <"+
+              ">, <".join(fired)+"> and rerun by <"+str(rerun)+">")
+
+    def getFiredEvals(self, world, vals):
+        '''
+        Replays one pass from vals
+        :return: (conditions of top level evals which held, condition of the one hitting RERUN)
+        '''
+        wd = WorldDict(world, vals)
+        fired = []
+        for we in self.worldevals:
+            if we.binop.eval(wd):
+                fired.append(we.condstr)
             try:
+                we.evaluate(wd)
+            except RerunException:
+                return fired, we.condstr
+        return fired, None
+
+    def getSchedule(self, world, start, count):
+        '''
+        Evaluates the character for a range of hours with quest values held fixed
+        :param world: World supplying quest values
+        :param start: first absolute hour
+        :param count: number of hours
+        :return: (nodes, descs), sequences with one entry per hour
+        '''
+        if numpy is not None:
+            try:
+                return self.runArrayEvals(world, numpy.arange(start, start+count))
+            except VectorFallback:
+                STATS.count("schedule fallbacks")
+        scratch = world.fork(quests=False)
+        nodes, descs = [], []
+        for hour in range(start, start+count):
+            scratch.hour = hour
+            vals = self.runEvals(scratch)[0]
+            nodes.append(vals["NODE"])
+            descs.append(vals["DESC"])
+        return nodes, descs
+
+    def runArrayEvals(self, world, hours):
+        '''
+        Evaluates every hour at once, hours which hit RERUN run another pass on their own
+        :param hours: integer numpy array of absolute hours
+        :return: (nodes, descs) object arrays
+        '''
+        wa = WorldArrayDict(world, hours, self.characteristics)
+        running = numpy.ones(len(hours), dtype=bool)
+        iters = 0
+        try:
+            while running.any():
+                if iters>=ARRAY_MAX_PASSES:
+                    # Likely cycling, which the hour by hour evaluation resolves
+                    raise VectorFallback("still rerunning after "+str(iters)+" passes")
+                iters += 1
+                mask = running
+                running = numpy.zeros(len(hours), dtype=bool)
                 for we in self.worldevals:
-                    we.evaluate(wd)
-            except RerunException as e:
-                running = True
-        if iters>=MAX_ITERS:
-            print("[!] Character iteration limit reached.")
-        return wd.vals
+                    reran = we.evaluateArray(wa, mask)
+                    running |= reran
+                    mask = mask & ~reran
+            return wa.getArray("NODE"), wa.getArray("DESC")
+        except (TypeError, ValueError, KeyError) as e:
+            # Operands numpy cannot combine elementwise, or outputs left unset
+            raise VectorFallback(str(e))
+
+    def invalidate(self):
+        '''
+        Drops cached evaluations and the timetable
+        '''
+        self.evalcache.clear()
+        self.timetable = None
+        self.thresholds = None
+
+    def getTimetable(self):
+        if self.timetable is None:
+            self.timetable = self.buildTimetable()
+        return self.timetable
+
+    def buildTimetable(self):
+        '''
+        Evaluates a character depending only on hour and weekday for every hour of the week
+        :return: (list of distinct (node, name, desc), slot -> entry index), or False
+        '''
+        if not self.getReads().issubset(WEEKLY_ATTRS):
+            return False
+        scratch = World()
+        entries = []
+        indices = {}
+        slots = []
+        try:
+            for slot in range(WEEK_HOURS):
+                scratch.hour = slot
+                vals = self.computeEvalDict(scratch)
+                entry = (vals["NODE"], vals["NAME"], vals["DESC"])
+                if entry not in indices:
+                    indices[entry] = len(entries)
+                    entries.append(entry)
+                slots.append(indices[entry])
+        except Exception:
+            # Leave errors to be raised by the regular evaluation
+            return False
+        if len(entries)<256:
+            slots = bytearray(slots)
+        return entries, slots
+
+    def getThresholds(self):
+        if self.thresholds is None:
+            thresholds = {}
+            for we in self.worldevals:
+                if not we.getTimeThresholds(thresholds):
+                    thresholds = False
+                    break
+            self.thresholds = thresholds
+        return self.thresholds
+
+    def getChangeHours(self, start, end):
+        '''
+        Finds the hours at which the evaluation may change without evaluating
+        :param start: absolute hour to start from
+        :param end: last absolute hour
+        :return: sorted list of hours in (start, end]
+        '''
+        thresholds = self.getThresholds()
+        if thresholds is False:
+            return range(start+1, end+1)
+        hours = set()
+        if "hour" in thresholds:
+            # hour also jumps from 23 back to 0
+            hourvals = set(v%24 for v in thresholds["hour"])
+            hourvals.add(0)
+            for day in range(start/24, end/24+1):
+                hours.update(day*24+v for v in hourvals)
+        if "day" in thresholds:
+            hours.update(v*24 for v in thresholds["day"])
+        if "weekday" in thresholds:
+            weekdays = set(v%7 for v in thresholds["weekday"])
+            weekdays.add(0)
+            hours.update(day*24 for day in range(start/24, end/24+1) if day%7 in weekdays)
+        return sorted(h for h in hours if start<h<=end)
+
+    def computePresence(self, world):
+        '''
+        Like getPresence but without caching, for worlds whose hour is set directly
+        '''
+        timetable = self.getTimetable()
+        if timetable:
+            entries, slots = timetable
+            return entries[slots[world.hour%WEEK_HOURS]]
+        eval_dict = self.runEvals(world)[0]
+        return eval_dict["NODE"], eval_dict["NAME"], eval_dict["DESC"]
+
+    def getPresence(self, world):
+        '''
+        :return: (node, name, desc) of character in current world state
+        '''
+        timetable = self.getTimetable()
+        if timetable:
+            entries, slots = timetable
+            return entries[slots[world.hour%WEEK_HOURS]]
+        eval_dict = self.getEvalDict(world)
+        return eval_dict["NODE"], eval_dict["NAME"], eval_dict["DESC"]
 
     def kill(self):
         self.alive = False
+        self.invalidate()
 
     def isInNode(self,nodename,world):
         if self.alive:
-            eval_dict = self.getEvalDict(world)
-            if eval_dict["NODE"]==nodename:
+            node, name, desc = self.getPresence(world)
+            if node==nodename:
                 return True
         return False
 
@@ -1,33 +1,49 @@
+import operator
+
 from AutoTokenizer import TextTokenizer
+from World import TIME_ATTRS
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 MAX_ITERS = 1000
+# {condition string: BinaryOp}, so repeated condition strings are only parsed once
+CONDITION_STRINGS = {}
+# {(left, right, op): BinaryOp}, operands being interned BinaryOps, so structurally equal
+# conditions anywhere in the process share one BinaryOp
+INTERNED_OPS = {}
+# Characters compile their evals to python at parse time, set False to interpret
+COMPILE_EVALS = True
 
 
 # noinspection PyPep8Naming
 class WorldEval(object):
+    __slots__ = ("condstr", "binop", "items", "shared")
+
     def __init__(self, dmobject):
         '''
         Contains a condition and a series of operations
-        :param condition: function: WorldDict -> boolean
+        :param dmobject: DMObject with the condition string as key
         '''
         self.condstr, objs = dmobject.k, dmobject.v
-        self.condition = makeConditionFromString(self.condstr)
-        self.nodenames = set()
+        self.binop = makeBinaryOpFromString(self.condstr)
         self.items = []
+        # Whether the condition only reads world attributes, set by markShared
+        self.shared = False
         for obj in objs:
             if obj.getType()=="OBJECT":
-                we = WorldEval(obj)
-                self.addRunWorldEval(we)
-                self.nodenames.update(we.getNodes())
+                self.addRunWorldEval(WorldEval(obj))
             elif obj.getType()=="ASSIGN":
-                self.addSetAttribute(obj.k,obj.v)
                 if obj.k.upper()=="NODE":
-                    self.nodenames.add(obj.v)
+                    self.addSetAttribute(intern(obj.k), intern(obj.v))
+                else:
+                    self.addSetAttribute(intern(obj.k), obj.v)
             elif obj.getType()=="ITEM":
-                if obj.k.upper()=="RERUN":
+                if obj.v.upper()=="RERUN":
                     self.addReRun()
                 else:
-                    print("[!] Unrecognized string: "+obj)
+                    print("[!] Unrecognized string: "+str(obj))
             else:
                 print("[!] Warning: unknown object: "+str(obj))
 
@@ -46,7 +62,10 @@ class WorldEval(object):
         self.items.append((2,None))
 
     def evaluate(self,worldstats):
-        if not self.condition(worldstats):
+        if self.shared:
+            if not worldstats.world.evalShared(self.binop):
+                return
+        elif not self.binop.eval(worldstats):
             return
         for (itemtype, item) in self.items:
             if itemtype==0:
@@ -57,8 +76,130 @@ class WorldEval(object):
             elif itemtype==2:
                 raise RerunException("Rerun called")
 
+    def evaluateArray(self, worldarrays, mask):
+        '''
+        Evaluates for every hour of a WorldArrayDict at once
+        :param worldarrays: WorldArrayDict
+        :param mask: boolean array of hours still running this pass
+        :return: boolean array of hours which hit RERUN
+        '''
+        reran = numpy.zeros(len(mask), dtype=bool)
+        mask = mask & worldarrays.toMask(self.binop.evalArray(worldarrays))
+        for (itemtype, item) in self.items:
+            if not mask.any():
+                break
+            if itemtype==0:
+                name, value = item
+                worldarrays.assign(name, value, mask)
+            elif itemtype==1:
+                r = item.evaluateArray(worldarrays, mask)
+                reran |= r
+                mask = mask & ~r
+            elif itemtype==2:
+                reran |= mask
+                break
+        return reran
+
+    def getTimeThresholds(self, thresholds):
+        '''
+        Adds the time attribute values at which this or a nested condition may change
+        :param thresholds: {attribute: set of values} to add to
+        :return: False if time attributes are used in a way that cannot be analysed
+        '''
+        if not getOperandThresholds(self.binop, thresholds):
+            return False
+        for (itemtype, item) in self.items:
+            if itemtype==1 and not item.getTimeThresholds(thresholds):
+                return False
+        return True
+
+    def markShared(self, local):
+        '''
+        Marks this and nested conditions reading no local attributes, so their results
+        are shared with every other character for a world state
+        :param local: set of attribute names the character may hold locally, None to
+        share nothing
+        '''
+        self.shared = local is not None and isinstance(self.binop, BinaryOp) and \
+                      local.isdisjoint(self.binop.getReads())
+        for (itemtype, item) in self.items:
+            if itemtype==1:
+                item.markShared(local)
+
+    def getAssignedNames(self):
+        '''
+        :return: set of attribute names this or a nested eval may assign
+        '''
+        names = set()
+        for (itemtype, item) in self.items:
+            if itemtype==0:
+                names.add(item[0])
+            elif itemtype==1:
+                names.update(item.getAssignedNames())
+        return names
+
+    def getAssigned(self, name):
+        '''
+        :return: list of values this or a nested eval may assign to name
+        '''
+        values = []
+        for (itemtype, item) in self.items:
+            if itemtype==0 and item[0]==name:
+                values.append(item[1])
+            elif itemtype==1:
+                values += item.getAssigned(name)
+        return values
+
     def getNodes(self):
-        return list(self.nodenames)
+        '''
+        :return: list of node names this or a nested eval may assign
+        '''
+        nodes = []
+        for (itemtype, item) in self.items:
+            if itemtype==0 and item[0].upper()=="NODE":
+                nodes.append(item[1])
+            elif itemtype==1:
+                nodes += item.getNodes()
+        return nodes
+
+    def getReads(self):
+        '''
+        :return: list of attribute names read by this condition and nested conditions
+        '''
+        reads = getOperandReads(self.binop)
+        for (itemtype, item) in self.items:
+            if itemtype==1:
+                reads += item.getReads()
+        return reads
+
+    def compile(self, lines, conds, indent="    "):
+        '''
+        Appends python source equivalent to evaluate to lines
+        :param lines: list of source lines
+        :param conds: list of shared conditions, referred to by index in the source
+        :param indent: indentation of the generated if statement
+        '''
+        if self.shared:
+            # Look the result up in the world's shared results, computing it if missing
+            cond = "conds["+str(len(conds))+"]"
+            conds.append(self.binop)
+            lines.append(indent+"r = shared.get("+cond+")")
+            lines.append(indent+"if r is None:")
+            lines.append(indent+"    r = shared["+cond+"] = "+self.binop.compile(False))
+            lines.append(indent+"if r:")
+        else:
+            lines.append(indent+"if "+compileOperand(self.binop)+":")
+        body = indent+"    "
+        if len(self.items)==0:
+            lines.append(body+"pass")
+        for (itemtype, item) in self.items:
+            if itemtype==0:
+                name, value = item
+                lines.append(body+"vals["+repr(name)+"] = "+repr(value))
+            elif itemtype==1:
+                item.compile(lines, conds, body)
+            elif itemtype==2:
+                lines.append(body+"return True")
 
     def __repr__(self):
         return str(self)
@@ -91,57 +232,170 @@ class WorldDict(object):
     def __setitem__(self, key, value):
         self.vals[key] = value
 
+
+# noinspection PyPep8Naming
+class VectorFallback(Exception):
+    '''
+    Raised when an evaluation has no array form, callers evaluate hour by hour instead
+    '''
+    pass
+
+
+# Marks hours in which a local attribute has not been assigned
+UNSET = object()
+
+
+# noinspection PyPep8Naming
+class WorldArrayDict(object):
+    def __init__(self, world, hours, vals=None):
+        '''
+        Like WorldDict but for a range of hours, time attributes are arrays while quest
+        values are those of world
+        :param world: World supplying quest values
+        :param hours: integer numpy array of absolute hours
+        :param vals: initial local attributes, each a value or an object array per hour
+        '''
+        self.world = world
+        self.hours = hours
+        self.vals = {}
+        if vals is not None:
+            self.vals.update(vals)
+
+    def __getitem__(self, item):
+        if item in self.vals:
+            val = self.vals[item]
+            if isinstance(val, numpy.ndarray) and (val==UNSET).any():
+                # Hours without a local value would read the world
+                raise VectorFallback(item+" is only assigned in some hours")
+            return val
+        if item=="hour":
+            return self.hours%24
+        elif item=="day":
+            return self.hours//24
+        elif item=="weekday":
+            return (self.hours//24)%7
+        attr = self.world.getWorldAttr(item)
+        if attr is not None: return attr
+        raise Exception("[!] Could not find "+item+" in world or local dictionaries")
+
+    def assign(self, name, value, mask):
+        '''
+        Sets name to value in the hours selected by mask
+        '''
+        if mask.all():
+            self.vals[name] = value
+            return
+        current = self.vals.get(name, UNSET)
+        if not isinstance(current, numpy.ndarray):
+            arr = numpy.empty(len(self.hours), dtype=object)
+            arr.fill(current)
+            current = arr
+        current[mask] = value
+        self.vals[name] = current
+
+    def getArray(self, name):
+        '''
+        :return: object array with the value of name for every hour
+        '''
+        val = self.vals[name]
+        if isinstance(val, numpy.ndarray):
+            if (val==UNSET).any():
+                raise KeyError(name)
+            return val
+        arr = numpy.empty(len(self.hours), dtype=object)
+        arr.fill(val)
+        return arr
+
+    def toMask(self, cond):
+        '''
+        :return: boolean array from a condition result, which may be a scalar
+        '''
+        if isinstance(cond, numpy.ndarray):
+            return cond.astype(bool)
+        return numpy.repeat(bool(cond), len(self.hours))
+
 class BinaryOp(object):
     INT_INT = ["+","-","*","/"]
     INT_BOOL = ["<",">","<=",">="]
     BOOL_BOOL = ["and","or","xor","xnor"]
+    COMPILED_OPS = {"+":"+", "-":"-", "*":"*", "/":"/",
+                    "<":"<", ">":">", "<=":"<=", ">=":">=",
+                    "and":"and", "or":"or", "xor":"!=", "xnor":"=="}
+    # Elementwise forms for evalArray, filled in below when numpy is available
+    ARRAY_OPS = {}
+    SCALAR_OPS = {"+": operator.add, "-": operator.sub, "*": operator.mul, "/": operator.div,
+                  "<": operator.lt, ">": operator.gt, "<=": operator.le, ">=": operator.ge,
+                  "and": lambda l, r: l and r, "or": lambda l, r: l or r,
+                  "xor": operator.ne, "xnor": operator.eq}
+
+    __slots__ = ("left", "lprim", "ldict", "right", "rprim", "rdict", "op", "fn")
 
     def __init__(self, left, right, op):
+        '''
+        Checks operator and operand types up front so eval can apply fn directly, use
+        internBinaryOp rather than constructing directly
+        '''
+        if op not in BinaryOp.SCALAR_OPS:
+            raise Exception("[!] Unknown operator "+op)
         self.left = left
         self.lprim = (type(left)==int) or (type(left)==bool)
         self.ldict = (type(left)==str)
         self.right = right
         self.rprim = (type(right)==int) or (type(right)==bool)
         self.rdict = (type(right)==str)
-        self.op = op
+        self.op = intern(op)
+        self.fn = BinaryOp.SCALAR_OPS[op]
+        if op=="/" and self.rprim and right==0:
+            raise Exception("[!] Division by zero in "+str(self))
+        if op in BinaryOp.INT_INT and (isBooleanOperand(left) or isBooleanOperand(right)):
+            print("[!] Arithmetic on a condition in "+str(self))
 
     def eval(self, worldstate):
-        if self.op in BinaryOp.INT_INT or self.op in BinaryOp.INT_BOOL:
-            if self.lprim:
-                l = self.left
-            elif self.ldict:
-                l = worldstate[self.left]
-            else:
-                l = self.left.eval(worldstate)
-            if self.rprim:
-                r = self.right
-            elif self.rdict:
-                r = worldstate[self.right]
-            else:
-                r = self.right.eval()
-            if self.op=="+": return l+r
-            if self.op=="-": return l-r
-            if self.op=="*": return l*r
-            if self.op=="/": return l/r
-            if self.op=="<": return l<r
-            if self.op==">": return l>r
-            if self.op=="<=": return l<=r
-            if self.op==">=": return l>=r
-        elif self.op in BinaryOp.BOOL_BOOL:
-            if self.lprim:
-                l = self.left
-            else:
-                l = self.left.eval(worldstate)
-            if self.rprim:
-                r = self.right
-            else:
-                r = self.right.eval(worldstate)
-            if self.op=="and": return l and r
-            if self.op=="or": return l or r
-            if self.op=="xor": return l != r
-            if self.op=="xnor": return l == r
+        if self.lprim:
+            l = self.left
+        elif self.ldict:
+            l = worldstate[self.left]
+        else:
+            l = self.left.eval(worldstate)
+        if self.rprim:
+            r = self.right
+        elif self.rdict:
+            r = worldstate[self.right]
         else:
-            raise Exception("[!] Unknown operator "+self.op)
+            r = self.right.eval(worldstate)
+        return self.fn(l, r)
+
+    def evalArray(self, worldarrays):
+        '''
+        Like eval but reading from a WorldArrayDict
+        :return: value or numpy array with one value per hour
+        '''
+        l = evalOperandArray(self.left, worldarrays)
+        r = evalOperandArray(self.right, worldarrays)
+        if not isinstance(l, numpy.ndarray) and not isinstance(r, numpy.ndarray):
+            return BinaryOp.SCALAR_OPS[self.op](l, r)
+        if isObjectOperand(l) or isObjectOperand(r):
+            # Compare mixed types elementwise with python semantics, as eval would
+            l, r = asObjectOperand(l), asObjectOperand(r)
+        return BinaryOp.ARRAY_OPS[self.op](l, r)
+
+    def getReads(self):
+        '''
+        :return: list of attribute names the operation looks up
+        '''
+        return getOperandReads(self.left)+getOperandReads(self.right)
+
+    def compile(self, local=True):
+        '''
+        :param local: False to only read world attributes
+        :return: python expression equivalent to eval, reading from vals and world
+        '''
+        left, right = compileOperand(self.left, local), compileOperand(self.right, local)
+        # Python's and/or skip the right operand, while eval evaluates it and may raise, so
+        # they are called through fn unless the right operand cannot raise
+        if self.op in ("and", "or") and not isSafeOperand(self.right):
+            return "ops["+repr(self.op)+"]("+left+", "+right+")"
+        return "("+left+" "+BinaryOp.COMPILED_OPS[self.op]+" "+right+")"
 
     def __repr__(self):
         return str(self)
@@ -150,10 +404,20 @@ class BinaryOp(object):
         return "("+str(self.left)+") "+self.op+" ("+str(self.right)+")"
 
 
+if numpy is not None:
+    # and/or only feed conditions, so their truth value is all that matters
+    BinaryOp.ARRAY_OPS = {"+": numpy.add, "-": numpy.subtract, "*": numpy.multiply,
+                          "/": numpy.floor_divide,
+                          "<": numpy.less, ">": numpy.greater,
+                          "<=": numpy.less_equal, ">=": numpy.greater_equal,
+                          "and": numpy.logical_and, "or": numpy.logical_or,
+                          "xor": numpy.not_equal, "xnor": numpy.equal}
+
+
 # noinspection PyPep8Naming
 class RerunException(Exception):
     def __init__(self,msg):
-        Exception.__init__(msg)
+        Exception.__init__(self, msg)
 
 
 # noinspection PyPep8Naming
@@ -163,11 +427,159 @@ def makeConditionFromString(s):
     :param s: string describing condtional expression
     :return: (WorldDict -> boolean)
     '''
-    tok = TextTokenizer(s)
-    cond = makeBinaryOpFromTokenizer(tok)
+    return makeConditionFromBinaryOp(makeBinaryOpFromString(s))
+
+
+# noinspection PyPep8Naming
+def makeConditionFromBinaryOp(cond):
     return lambda ws: cond.eval(ws)
 
 
+# noinspection PyPep8Naming
+def makeBinaryOpFromString(s):
+    binop = CONDITION_STRINGS.get(s)
+    if binop is None:
+        tok = TextTokenizer(s)
+        binop = makeBinaryOpFromTokenizer(tok)
+        CONDITION_STRINGS[s] = binop
+    return binop
+
+
+# noinspection PyPep8Naming
+def internBinaryOp(left, right, op):
+    '''
+    :param left: int, interned attribute name or interned BinaryOp
+    :param right: int, interned attribute name or interned BinaryOp
+    :return: the BinaryOp shared by every structurally equal condition
+    '''
+    key = (left, right, op)
+    binop = INTERNED_OPS.get(key)
+    if binop is None:
+        binop = BinaryOp(left, right, op)
+        INTERNED_OPS[key] = binop
+    return binop
+
+
+# noinspection PyPep8Naming
+def isBooleanOperand(operand):
+    return isinstance(operand, BinaryOp) and operand.op not in BinaryOp.INT_INT
+
+
+# noinspection PyPep8Naming
+def compileOperand(operand, local=True):
+    '''
+    Makes a python expression for a BinaryOp operand
+    :param operand: int, bool, attribute name or BinaryOp
+    :param local: False to only read world attributes
+    :return: python source string
+    '''
+    if type(operand)==int or type(operand)==bool:
+        return repr(operand)
+    elif type(operand)==str:
+        if not local:
+            return "lookup(world, "+repr(operand)+")"
+        return "(vals["+repr(operand)+"] if "+repr(operand)+" in vals else lookup(world, "+repr(operand)+"))"
+    return operand.compile(local)
+
+
+# noinspection PyPep8Naming
+def isSafeOperand(operand):
+    '''
+    :return: True if evaluating operand never raises, so skipping it changes nothing
+    '''
+    if type(operand)==int or type(operand)==bool:
+        return True
+    elif type(operand)==str:
+        # Time attributes always exist, other names may be missing
+        return operand in TIME_ATTRS
+    # Arithmetic may fail on a value of the wrong type, comparisons never do
+    return operand.op not in BinaryOp.INT_INT and isSafeOperand(operand.left) and \
+        isSafeOperand(operand.right)
+
+
+# noinspection PyPep8Naming
+def evalOperandArray(operand, worldarrays):
+    if type(operand)==int or type(operand)==bool:
+        return operand
+    elif type(operand)==str:
+        return worldarrays[operand]
+    return operand.evalArray(worldarrays)
+
+
+# noinspection PyPep8Naming
+def isObjectOperand(val):
+    if isinstance(val, numpy.ndarray):
+        return val.dtype==object
+    return not isinstance(val, (int, long, bool))
+
+
+# noinspection PyPep8Naming
+def asObjectOperand(val):
+    if isinstance(val, numpy.ndarray) and val.dtype!=object:
+        return val.astype(object)
+    return val
+
+
+# noinspection PyPep8Naming
+def getOperandThresholds(operand, thresholds):
+    '''
+    Finds values of time attributes around which a comparison against a literal flips
+    :param operand: int, bool, attribute name or BinaryOp
+    :param thresholds: {attribute: set of values} to add to, value v means the result
+    may differ between attribute values v-1 and v
+    :return: False if a time attribute is used other than compared with a literal
+    '''
+    if type(operand)==str:
+        return operand not in TIME_ATTRS
+    elif not isinstance(operand, BinaryOp):
+        return True
+    left, right = operand.left, operand.right
+    if operand.op in BinaryOp.INT_BOOL or operand.op in ["xor", "xnor"]:
+        if type(left)==str and left in TIME_ATTRS and type(right)==int:
+            thresholds.setdefault(left, set()).update([right, right+1])
+            return True
+        if type(right)==str and right in TIME_ATTRS and type(left)==int:
+            thresholds.setdefault(right, set()).update([left, left+1])
+            return True
+    return getOperandThresholds(left, thresholds) and getOperandThresholds(right, thresholds)
+
+
+# noinspection PyPep8Naming
+def getOperandReads(operand):
+    if type(operand)==str:
+        return [operand]
+    elif isinstance(operand, BinaryOp):
+        return operand.getReads()
+    return []
+
+
+# noinspection PyPep8Naming
+def lookupWorldAttr(world, name):
+    attr = world.getWorldAttr(name)
+    if attr is not None: return attr
+    raise Exception("[!] Could not find "+name+" in world or local dictionaries")
+
+
+# noinspection PyPep8Naming
+def compileWorldEvals(worldevals, name="character"):
+    '''
+    Compiles a list of WorldEvals into a single python function performing one pass
+    :param worldevals: WorldEvals in evaluation order
+    :param name: name used in tracebacks
+    :return: function (vals dict, World) -> True if RERUN was hit
+    '''
+    lines = ["def evaluate(vals, world):"]
+    conds = []
+    for we in worldevals:
+        we.compile(lines, conds)
+    if conds:
+        lines.insert(1, "    shared = world.getSharedResults()")
+    lines.append("    return False")
+    namespace = {"lookup": lookupWorldAttr, "conds": conds, "ops": BinaryOp.SCALAR_OPS}
+    exec(compile("\n".join(lines)+"\n", "<compiled "+name+">", "exec"), namespace)
+    return namespace["evaluate"]
+
+
 # noinspection PyPep8Naming
 def makeBinaryOpFromTokenizer(tok):
     ll = tok.consume()
@@ -180,7 +592,7 @@ def makeBinaryOpFromTokenizer(tok):
         try:
             left = int(ll)
         except ValueError:
-            left = ll
+            left = intern(ll)
 
     op = tok.peek()
     if op == ")":
@@ -204,5 +616,5 @@ def makeBinaryOpFromTokenizer(tok):
         try:
             right = int(rl)
         except ValueError:
-            right = rl
-    return BinaryOp(left, right, op)
+            right = intern(rl)
+    return internBinaryOp(left, right, op)
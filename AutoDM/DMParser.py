@@ -1,6 +1,14 @@
+import itertools
+import mmap
+import multiprocessing
 import os
+import time
 
-from AutoTokenizer import FileTokenizer
+import AutoTokenizer
+from AutoTokenizer import ChunkTokenizer, FileTokenizer, ListTokenizer, scanBuffer, scanBufferOffsets, \
+    scanObjectOffsets
+from Instrument import STATS
+from ParseCache import ParseCache
 from DMEval import *
 from World import *
 from Quests import *
@@ -11,17 +19,21 @@ DEFAULT_QUESTDIR = "/quests"
 DEFAULT_CHARFILE = "/characters.txt"
 DEFAULT_CHARDIR = "/characters"
 DEFAULT_WORLDDIR = "/world"
+# Bytes of a file tokenized at once when streaming objects from it
+STREAM_CHUNK_BYTES = 1024*1024
 
-class DMParseClass:
+class DMParseClass(object):
+    __slots__ = ()
     t = "UNKNOWN"
     def getType(self):
         return self.t
 
 class DMObject(DMParseClass):
+    __slots__ = ("k", "v")
+    t = "OBJECT"
     def __init__(self,label,value):
         self.k = label
         self.v = value
-        self.t = "OBJECT"
 
     def __repr__(self):
         return (str(self.k)+"{"+str(self.v)+"}")
@@ -29,27 +41,127 @@ class DMObject(DMParseClass):
         return self.__repr__()
 
 class DMItem(DMParseClass):
+    __slots__ = ("v",)
+    t = "ITEM"
     def __init__(self,item):
         self.v = item
-        self.t = "ITEM"
     def __repr__(self):
         return "("+str(self.v)+")"
     def __str__(self):
         return self.__repr__()
 
 class DMAssign(DMParseClass):
+    __slots__ = ("k", "v")
+    t = "ASSIGN"
     def __init__(self,label,value):
         self.k = label
         self.v = value
-        self.t = "ASSIGN"
     def __repr__(self):
         return "("+str(self.k)+"="+str(self.v)+")"
     def __str__(self):
         return self.__repr__()
 
-class WorldParser:
-    def __init__(self, filename):
+class DMObjectParser:
+    '''
+    Grammar of world files, independent of any world directory
+    '''
+    def parseFile(self, filename):
+        return list(self.consumeDMObjects(FileTokenizer(filename)))
+
+    def iterFileObjects(self, filename):
+        '''
+        Yields the DM objects of a file, tokenizing it in chunks so only the tokens of the
+        current chunk are held
+        :return: generator of DMObjects
+        '''
+        if not AutoTokenizer.BULK_TOKENIZER or os.path.getsize(filename)==0:
+            for dmo in self.parseFile(filename):
+                yield dmo
+            return
+        with open(filename, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                # The parser reads one token stream across chunks, so it accepts and
+                # rejects exactly what parseFile does wherever the chunks are cut
+                tokenizer = ChunkTokenizer(scanBuffer(buf[start:end])
+                                           for start, end in iterChunkBounds(buf))
+                for dmo in self.consumeDMObjects(tokenizer):
+                    yield dmo
+            finally:
+                buf.close()
+
+    def consumeDMObjects(self,tokenizer):
+        '''
+        Yields DM objects as they are parsed
+        :param tokenizer: input tokenizer containing multiple DM Objects
+        :return: generator of DMObjects
+        '''
+        while tokenizer.hasNext():
+            yield self.consumeDMObject(tokenizer)
+
+    def consumeDMObject(self, tokenizer, id=None):
+        '''
+        obj := id { obj_or_item }
+        obj_or_item := obj, obj_or_item | item, obj_or_item
+        item := TEXT
+        '''
+        # First thing we see should be a quest id
+        if id==None:
+            id = tokenizer.consume()
+        open = tokenizer.consume()
+        if open!="{":
+            raise Exception("[!] Expect { opening object but found "+open)
+        object_contents = []
+        while True:
+            val = tokenizer.peek()
+            if val=="}":
+                # End of object
+                tokenizer.consume()
+                return DMObject(id, object_contents)
+            else:
+                text = tokenizer.consume()
+                open = tokenizer.peek()
+                if open=="{":
+                    # Object
+                    object_contents.append(self.consumeDMObject(tokenizer, text))
+                    comma = tokenizer.consume()
+                    if comma != ",":
+                        raise Exception("[!] Expected comma between entries")
+                elif open=="=":
+                    # Set value
+                    tokenizer.consume()
+                    text_acc = ""
+                    n_text = ""
+                    while n_text!=",":
+                        text_acc += n_text
+                        n_text = tokenizer.consume()
+                    object_contents.append(DMAssign(text,text_acc))
+                else:
+                    # Item
+                    n_text = ""
+                    while n_text!=",":
+                        text += n_text
+                        n_text = tokenizer.consume()
+                    object_contents.append(DMItem(text))
+
+
+class WorldParser(DMObjectParser):
+    def __init__(self, filename, processes=1, cachedir=None, lazy=False):
+        '''
+        :param filename: world directory
+        :param processes: number of processes parsing files, 1 parses serially
+        :param cachedir: directory caching parsed files between runs, None disables
+        :param lazy: parse world nodes when first used rather than up front
+        '''
         self.worldpath = filename
+        self.processes = processes
+        self.lazy = lazy
+        self.pool = None
+        self.cache = None
+        # {filename: names of the top level objects parsed from it}
+        self.sources = {}
+        if cachedir is not None:
+            self.cache = ParseCache(cachedir)
 
         if not os.path.isdir(self.worldpath):
             print("[!] Path is not world directory")
@@ -79,22 +191,99 @@ class WorldParser:
         Parses directory
         :return: World object containing all relevant data
         '''
-        quests = self.parseQuests()
-        characters = self.parseCharacters()
-        worldnodes = self.parseWorldNodes()
-
         w = World()
-
-        for node in worldnodes:
-            w.addWorldNode(node)
-        for node in worldnodes:
-            node.linkNodes(w)
+        # Linked once all nodes exist, in parse order
+        characters = []
+        try:
+            # Each object is converted and added as soon as it is parsed, so its DMObject
+            # tree can be freed before the next is parsed
+            for dmo in self.parseDMObjectsFromFiles(self.questpath):
+                w.addQuestline(self.convertDMObjectToQuest(dmo))
+            for dmo in self.parseDMObjectsFromFiles(self.characterpath):
+                character = self.convertDMObjectToCharacter(dmo)
+                w.addCharacter(character)
+                characters.append(character)
+            if self.lazy:
+                self.indexWorldNodes(w)
+            else:
+                for dmo in self.parseDMObjectsFromFiles(self.worldnodepath):
+                    w.addWorldNode(self.convertDMObjectToWorldNode(dmo))
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+        if not self.lazy:
+            for node in w.nodes.values():
+                node.linkNodes(w)
         for character in characters:
-            character.linkPossibleNodes(w)
-        for quest in quests:
-            w.addQuestline(quest)
+            # A character overwritten by a later one of the same name is not linked
+            if w.getCharacter(character["NAME"]) is character:
+                character.linkPossibleNodes(w)
+        if self.cache is not None:
+            self.cache.prune()
         return w
 
+    def indexWorldNodes(self, world):
+        '''
+        Records where each world node is in its file rather than parsing it, so world
+        parses and links nodes the first time they are used
+        '''
+        world.makeLazy(lambda name, location: self.loadWorldNode(world, location),
+                       self.scanTransitions)
+        for f in listSourceFiles(self.worldnodepath):
+            offsets = self.scanOffsets(f)
+            world.nodes.indexFile(f, offsets)
+            self.sources[f] = [name for (name, start, end) in offsets]
+
+    def scanOffsets(self, filename):
+        '''
+        :return: list of (name, start, end) of the objects in filename, cached by size and
+        modification time so unchanged files are not read
+        '''
+        if self.cache is None:
+            return scanObjectOffsets(filename)
+        key = self.cache.getStatKey(filename, "offsets")
+        offsets = self.cache.get(key)
+        if offsets is None:
+            offsets = scanObjectOffsets(filename)
+            self.cache.put(key, offsets)
+        return offsets
+
+    def loadWorldNode(self, world, location):
+        '''
+        Parses a single world node from its place in a file and links it into world
+        :param location: (filename, start, end) from scanOffsets
+        '''
+        filename, start, end = location
+        with open(filename, "rb") as f:
+            f.seek(start)
+            data = f.read(end-start)
+        dmo = self.consumeDMObject(ListTokenizer(scanBuffer(data)))
+        node = self.convertDMObjectToWorldNode(dmo)
+        world.linkLazyNode(node)
+        STATS.count("nodes loaded")
+        return node
+
+    def scanTransitions(self, filename, offsets):
+        '''
+        Reads the transitions of world nodes without building them, for routing
+        :param offsets: list of (name, start, end) from scanOffsets
+        :return: {name: {direction: node name}}
+        '''
+        transitions = {}
+        with open(filename, "rb") as f:
+            data = f.read()
+        for (name, start, end) in offsets:
+            dmo = self.consumeDMObject(ListTokenizer(scanBuffer(data[start:end])))
+            transitions[name] = {}
+            for obj in dmo.v:
+                if obj.getType()=="OBJECT" and obj.k.upper()=="TRANS":
+                    label, trans = self.convertDMObjectToDict(obj)
+                    for k in trans:
+                        transitions[name][intern(k)] = intern(trans[k])
+        return transitions
+
     def parseQuests(self):
         questobjects = self.parseDMObjectsFromFiles(self.questpath)
         return self.convertDMObjectsToQuests(questobjects)
@@ -108,39 +297,40 @@ class WorldParser:
         return self.convertDMObjectsToWorldNodes(worldobjects)
 
     def convertDMObjectsToWorldNodes(self, dmobjects):
-        nodes = []
-        for dmo in dmobjects:
-            name, worldnode = dmo.k, dmo.v
-            node = WorldNode(name)
-            for obj in worldnode:
-                if obj.getType()=="ITEM":
-                    node.setDescription(obj.v)
-                elif obj.getType()=="OBJECT":
-                    if obj.k.upper()=="TRANS":
-                        label, transitions = self.convertDMObjectToDict(obj)
-                        for k in transitions:
-                            node.addDummyNode(k,transitions[k])
-                    else:
-                        print("[!] Unknown node attribute "+str(obj)+" in node "+name)
-                elif obj.getType()=="ASSIGN":
-                    print("[!] Unexpected assignment "+str(obj)+" in node "+name)
-            nodes.append(node)
-        return nodes
+        return [self.convertDMObjectToWorldNode(dmo) for dmo in dmobjects]
 
-    def convertDMObjectsToCharacters(self, dmobjects):
-        chars = []
-        for dmo in dmobjects:
-            name, charobj = dmo.k, dmo.v
-            character = WorldCharacter(name)
-            for obj in charobj:
-                if obj.getType()=="OBJECT":
-                    character.addWorldEval(WorldEval(obj))
-                elif obj.getType()=="ASSIGN":
-                    character.addCharacteristic(obj.k,obj.v)
+    def convertDMObjectToWorldNode(self, dmo):
+        name, worldnode = dmo.k, dmo.v
+        node = WorldNode(name)
+        for obj in worldnode:
+            if obj.getType()=="ITEM":
+                node.setDescription(obj.v)
+            elif obj.getType()=="OBJECT":
+                if obj.k.upper()=="TRANS":
+                    label, transitions = self.convertDMObjectToDict(obj)
+                    for k in transitions:
+                        node.addDummyNode(k,transitions[k])
                 else:
-                    print("[!] Warning: unknown object: "+str(obj))
-            chars.append(character)
-        return chars
+                    print("[!] Unknown node attribute "+str(obj)+" in node "+name)
+            elif obj.getType()=="ASSIGN":
+                print("[!] Unexpected assignment "+str(obj)+" in node "+name)
+        return node
+
+    def convertDMObjectsToCharacters(self, dmobjects):
+        return [self.convertDMObjectToCharacter(dmo) for dmo in dmobjects]
+
+    def convertDMObjectToCharacter(self, dmo):
+        name, charobj = dmo.k, dmo.v
+        character = WorldCharacter(name)
+        for obj in charobj:
+            if obj.getType()=="OBJECT":
+                character.addWorldEval(WorldEval(obj))
+            elif obj.getType()=="ASSIGN":
+                character.addCharacteristic(obj.k,obj.v)
+            else:
+                print("[!] Warning: unknown object: "+str(obj))
+        character.compileEvals()
+        return character
 
     def convertDMObjectsToQuests(self, dmobjects):
         '''
@@ -148,103 +338,178 @@ class WorldParser:
         :param dmobjects: dmobjects with appropraite properties
         :return: list of questlines
         '''
-        quests = []
-        for dmo in dmobjects:
-            # questobj should be a list of nodes
-            questname, questobj = dmo.k, dmo.v
-            ql = Questline(questname)
-            for qo in questobj:
-                # Val is qnode value
-                # qnodeobj is description and transitions
-                val, qnodeobj = qo.k, qo.v
-                qn = QuestNode(int(val), qnodeobj[0].v)
-                if len(qnodeobj)>1:
-                    for trans in qnodeobj[1:]:
-                        colonindx = trans.v.find(":")
-                        if colonindx>-1:
-                            t = int(trans.v[:colonindx])
-                            det = trans.v[colonindx+1:]
-                            qn.addTransition(t, det)
-                        else:
-                            qn.addTransition(int(trans.v))
-                ql.addQuestNode(int(val), qn)
-            quests.append(ql)
-        return quests
+        return [self.convertDMObjectToQuest(dmo) for dmo in dmobjects]
+
+    def convertDMObjectToQuest(self, dmo):
+        # questobj should be a list of nodes
+        questname, questobj = dmo.k, dmo.v
+        ql = Questline(questname)
+        for qo in questobj:
+            # Val is qnode value
+            # qnodeobj is description and transitions
+            val, qnodeobj = qo.k, qo.v
+            qn = QuestNode(int(val), qnodeobj[0].v)
+            if len(qnodeobj)>1:
+                for trans in qnodeobj[1:]:
+                    colonindx = trans.v.find(":")
+                    if colonindx>-1:
+                        t = int(trans.v[:colonindx])
+                        det = trans.v[colonindx+1:]
+                        qn.addTransition(t, det)
+                    else:
+                        qn.addTransition(int(trans.v))
+            ql.addQuestNode(int(val), qn)
+        ql.getReachability()
+        return ql
 
     def parseDMObjectsFromFiles(self, fileordir):
         '''
-        Returns a list of DM objects from a directory of files or single file
+        Yields DM objects from a directory of files or single file
         :param fileordir: filepath or directory with files
-        :return: list of dmobjects
-        '''
-        dm_objects = []
-        if os.path.isdir(fileordir):
-            for (path, dirs, files) in os.walk(fileordir):
-                for f in files:
-                    tok = FileTokenizer(path+"/"+f)
-                    new_quests = self.consumeDMObjects(tok)
-                    dm_objects.extend(new_quests)
+        :return: generator of dmobjects
+        '''
+        filenames = listSourceFiles(fileordir)
+        for f, dmobjects in itertools.izip(filenames, self.iterFiles(filenames)):
+            names = []
+            for dmo in dmobjects:
+                names.append(dmo.k)
+                yield dmo
+            self.sources[f] = names
+
+    def getSourceRoots(self):
+        '''
+        :return: [(kind, quest/character/world node file or directory)]
+        '''
+        return [("quest", self.questpath),
+                ("character", self.characterpath),
+                ("node", self.worldnodepath)]
+
+    def getFileKind(self, filename):
+        for kind, root in self.getSourceRoots():
+            if filename==root or filename.startswith(root+"/"):
+                return kind
+        return None
+
+    def reloadFiles(self, world, filenames):
+        '''
+        Reparses changed, added or deleted files and swaps their objects into world,
+        keeping quest values, character deaths and node identities
+        :param world: World previously returned by parse
+        :param filenames: files to reload
+        '''
+        bykind = {"quest": [], "character": [], "node": []}
+        for f in filenames:
+            kind = self.getFileKind(f)
+            if kind is None:
+                print("[!] Not a world file: "+f)
+            else:
+                bykind[kind].append(f)
+
+        for f in bykind["quest"]:
+            quests = self.convertDMObjectsToQuests(self.reparseFile(f))
+            for ql in quests:
+                world.replaceQuestline(ql)
+            for name in self.updateSources(f, quests, lambda ql: ql.name):
+                world.removeQuestline(name)
+        for f in bykind["node"]:
+            if isinstance(world.nodes, LazyNodes):
+                self.reindexFile(world, f)
+                continue
+            nodes = self.convertDMObjectsToWorldNodes(self.reparseFile(f))
+            for node in nodes:
+                world.replaceWorldNode(node)
+            for name in self.updateSources(f, nodes, lambda node: node.name):
+                world.removeWorldNode(name)
+        for f in bykind["character"]:
+            characters = self.convertDMObjectsToCharacters(self.reparseFile(f))
+            for character in characters:
+                world.replaceCharacter(character)
+            for name in self.updateSources(f, characters, lambda c: c["NAME"]):
+                old = world.getCharacter(name)
+                if old is not None:
+                    world.dropCharacter(old)
+
+    def reindexFile(self, world, filename):
+        '''
+        Rescans a world node file of a lazy world, its nodes are parsed again when next used
+        '''
+        offsets = []
+        if os.path.exists(filename):
+            offsets = self.scanOffsets(filename)
+        removed = self.updateSources(filename, offsets, lambda o: o[0])
+        # Parsed copies of removed nodes, so they can still be unlinked once unindexed
+        stale = dict((name, world.getLoadedNode(name)) for name in removed)
+        # Index first, so nothing parses the new file at its old offsets
+        world.nodes.indexFile(filename, offsets)
+        for name in removed:
+            world.removeWorldNode(name, stale[name])
+        world.routes.invalidate()
+        # Parsed copies of the file's nodes were dropped, so renders of them are stale
+        world.contentChanged()
+
+    def reparseFile(self, filename):
+        if not os.path.exists(filename):
+            return []
+        return self.parseFiles([filename])[0]
+
+    def updateSources(self, filename, objects, getname):
+        '''
+        Records names of objects now parsed from filename
+        :return: names no longer defined in filename
+        '''
+        names = [getname(o) for o in objects]
+        removed = set(self.sources.get(filename, [])).difference(names)
+        if os.path.exists(filename):
+            self.sources[filename] = names
         else:
-            tokenizer = FileTokenizer(fileordir)
-            dm_objects = self.consumeDMObjects(tokenizer)
-        return dm_objects
+            self.sources.pop(filename, None)
+        return removed
 
-    def consumeDMObjects(self,tokenizer):
+    def parseFiles(self, filenames):
         '''
-        Returns list of DM objects
-        :param tokenizer: input tokenizer containing multiple DM Objects
-        :return: [DMObjects]
+        :param filenames: list of files
+        :return: list of lists of dmobjects, in the order of filenames
         '''
-        quests = []
-        while tokenizer.hasNext():
-            quest = self.consumeDMObject(tokenizer)
-            quests.append(quest)
-        return quests
+        return [list(dmobjects) for dmobjects in self.iterFiles(filenames)]
 
-    def consumeDMObject(self, tokenizer, id=None):
+    def iterFiles(self, filenames):
         '''
-        obj := id { obj_or_item }
-        obj_or_item := obj, obj_or_item | item, obj_or_item
-        item := TEXT
+        Loads files from the cache if possible, parsing and caching the rest, in a process
+        pool if enabled
+        :param filenames: list of files
+        :return: generator of iterables of dmobjects, one for each file in order
         '''
-        # First thing we see should be a quest id
-        if id==None:
-            id = tokenizer.consume()
-        open = tokenizer.consume()
-        if open!="{":
-            raise Exception("[!] Expect { opening object but found "+open)
-        object_contents = []
-        while True:
-            val = tokenizer.peek()
-            if val=="}":
-                # End of object
-                tokenizer.consume()
-                return DMObject(id, object_contents)
+        keys = [None]*len(filenames)
+        if self.cache is not None:
+            keys = [self.cache.getKey(f) for f in filenames]
+        missing = [f for f, k in itertools.izip(filenames, keys) if k is None or not self.cache.has(k)]
+        parsed = None
+        if self.processes>1 and len(missing)>1:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes)
+            parsed = self.pool.imap(timeDMObjectsFromFile, missing, 1)
+            missing = set(missing)
+        for f, k in itertools.izip(filenames, keys):
+            if parsed is not None and f in missing:
+                dmobjects, seconds = next(parsed)
             else:
-                text = tokenizer.consume()
-                open = tokenizer.peek()
-                if open=="{":
-                    # Object
-                    object_contents.append(self.consumeDMObject(tokenizer, text))
-                    comma = tokenizer.consume()
-                    if comma != ",":
-                        raise Exception("[!] Expected comma between entries")
-                elif open=="=":
-                    # Set value
-                    tokenizer.consume()
-                    text_acc = ""
-                    n_text = ""
-                    while n_text!=",":
-                        text_acc += n_text
-                        n_text = tokenizer.consume()
-                    object_contents.append(DMAssign(text,text_acc))
-                else:
-                    # Item
-                    n_text = ""
-                    while n_text!=",":
-                        text += n_text
-                        n_text = tokenizer.consume()
-                    object_contents.append(DMItem(text))
+                data = None
+                if k is not None:
+                    data = self.cache.get(k)
+                if data is not None:
+                    STATS.count("files cached")
+                    yield (decodeDMObject(d) for d in data)
+                    continue
+                if k is None and not STATS.enabled:
+                    # Nothing needs the whole file, so objects are used as they are parsed
+                    yield self.iterFileObjects(f)
+                    continue
+                dmobjects, seconds = timeDMObjectsFromFile(f)
+            if STATS.enabled:
+                STATS.recordFile(f, seconds)
+            if k is not None:
+                self.cache.put(k, [encodeDMObject(dmo) for dmo in dmobjects])
+            yield dmobjects
 
     def convertDMObjectToDict(self,dmobject):
         label = dmobject.k
@@ -257,6 +522,73 @@ class WorldParser:
                 print("[!] Unexpected entry in obj dictionary "+str(e))
         return label, new_dict
 
+def iterChunkBounds(buf):
+    '''
+    Splits a buffer after closing braces of top level objects, which the tokenizer never
+    finds inside a token, so tokenizing the pieces gives the tokens of the whole buffer
+    :return: generator of (start, end) of pieces of about STREAM_CHUNK_BYTES
+    '''
+    start = 0
+    for (name, objstart, objend) in scanBufferOffsets(buf):
+        if objend-start>=STREAM_CHUNK_BYTES:
+            yield start, objend
+            start = objend
+    if start<len(buf):
+        yield start, len(buf)
+
+
+def listSourceFiles(fileordir):
+    '''
+    :param fileordir: filepath or directory with files
+    :return: list of files in the order they are parsed
+    '''
+    if not os.path.isdir(fileordir):
+        return [fileordir]
+    filenames = []
+    for (path, dirs, files) in os.walk(fileordir):
+        for f in files:
+            filenames.append(path+"/"+f)
+    return filenames
+
+
+def encodeDMObject(dmo):
+    '''
+    :return: dmo as nested tuples which marshal can store
+    '''
+    if dmo.getType()=="OBJECT":
+        return (0, dmo.k, [encodeDMObject(o) for o in dmo.v])
+    elif dmo.getType()=="ASSIGN":
+        return (1, dmo.k, dmo.v)
+    return (2, dmo.v)
+
+
+def decodeDMObject(data):
+    '''
+    Inverse of encodeDMObject
+    '''
+    if data[0]==0:
+        return DMObject(data[1], [decodeDMObject(d) for d in data[2]])
+    elif data[0]==1:
+        return DMAssign(data[1], data[2])
+    return DMItem(data[1])
+
+
+def parseDMObjectsFromFile(filename):
+    '''
+    Parses a single file, module level so it can be sent to worker processes
+    '''
+    return DMObjectParser().parseFile(filename)
+
+
+def timeDMObjectsFromFile(filename):
+    '''
+    :return: (dmobjects, seconds spent parsing)
+    '''
+    start = time.time()
+    dmobjects = parseDMObjectsFromFile(filename)
+    return dmobjects, time.time()-start
+
+
 def listAllFilesInDir(dirname, maxdepth=10):
     list = []
     depth = 0
@@ -0,0 +1,105 @@
+'''
+Serves many players over a line protocol from a single parsed world
+'''
+import asynchat
+import asyncore
+import os
+import socket
+import sys
+
+from AutoDM import WorldRunner, parseOptions
+from DMParser import WorldParser
+from Rendering import OutputSink
+
+DEFAULT_PORT = 4040
+
+
+# noinspection PyPep8Naming
+class SessionRunner(WorldRunner):
+    def __init__(self, world, channel, printwidth=60):
+        '''
+        :param world: World forked for this session
+        :param channel: SessionChannel receiving output
+        '''
+        WorldRunner.__init__(self, world, None, printwidth)
+        self.channel = channel
+        self.sink = OutputSink(channel.push)
+
+
+# noinspection PyPep8Naming
+class SessionChannel(asynchat.async_chat):
+    def __init__(self, sock, world):
+        asynchat.async_chat.__init__(self, sock)
+        self.set_terminator("\n")
+        self.buffer = []
+        self.runner = SessionRunner(world.fork(), self)
+        self.runner.start()
+        self.prompt()
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        line = "".join(self.buffer).rstrip("\r")
+        self.buffer = []
+        try:
+            running = self.runner.execute(line)
+        except Exception as e:
+            self.runner.printFormat("Error: "+str(e))
+            running = True
+        if running:
+            self.prompt()
+        else:
+            self.runner.printFormat("Goodbye!")
+            self.runner.sink.flush()
+            self.close_when_done()
+
+    def prompt(self):
+        self.runner.printFormat("What will you do?")
+        self.runner.sink.write(">> ", "")
+        self.runner.sink.flush()
+
+
+# noinspection PyPep8Naming
+class DMServer(asyncore.dispatcher):
+    def __init__(self, world, address, family=socket.AF_INET):
+        '''
+        :param world: parsed World shared by all sessions
+        :param address: (host, port) for TCP or a path for a unix socket
+        :param family: socket.AF_INET or socket.AF_UNIX
+        '''
+        asyncore.dispatcher.__init__(self)
+        self.world = world
+        self.create_socket(family, socket.SOCK_STREAM)
+        if family==socket.AF_INET:
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            SessionChannel(pair[0], self.world)
+
+    def serve(self):
+        # poll has no limit on the number of open connections, unlike select
+        asyncore.loop(use_poll=True)
+
+
+if __name__ == "__main__":
+    args, options = parseOptions(sys.argv)
+    if len(args)!=2:
+        print("CLI usage: python DMServer.py [worldpath] [--host=HOST] [--port=N] [--unix=PATH]")
+        sys.exit(1)
+    p = WorldParser(args[1], processes=int(options.get("processes", 1)))
+    w = p.parse()
+    if "unix" in options:
+        if os.path.exists(options["unix"]):
+            os.remove(options["unix"])
+        server = DMServer(w, options["unix"], socket.AF_UNIX)
+        print("Serving on "+options["unix"])
+    else:
+        address = (options.get("host", "localhost"), int(options.get("port", DEFAULT_PORT)))
+        server = DMServer(w, address)
+        print("Serving on "+address[0]+":"+str(address[1]))
+    server.serve()
@@ -0,0 +1,92 @@
+'''
+Optional counters and timings for parsing, character evaluation and commands
+'''
+import bisect
+import json
+
+# Upper bounds of command latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000]
+
+
+# noinspection PyPep8Naming
+class Stats(object):
+    def __init__(self):
+        # Checked before recording anything, so disabled instrumentation costs one lookup
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        # {character name: [evaluations, seconds, total iterations, max iterations]}
+        self.evals = {}
+        # {filename: seconds}
+        self.files = {}
+        # {command: [count, seconds, bucket counts]}
+        self.commands = {}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0)+n
+
+    def recordEval(self, name, seconds, iters):
+        '''
+        :param name: character name
+        :param seconds: time spent evaluating
+        :param iters: passes over the character's evals, each one after the first is a rerun
+        '''
+        if name not in self.evals:
+            self.evals[name] = [0, 0.0, 0, 0]
+        entry = self.evals[name]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += iters
+        entry[3] = max(entry[3], iters)
+        self.count("evaluations")
+        self.count("eval passes", iters)
+        self.count("reruns", iters-1)
+
+    def recordFile(self, filename, seconds):
+        self.files[filename] = seconds
+        self.count("files parsed")
+
+    def recordCommand(self, cmd, seconds):
+        if cmd not in self.commands:
+            self.commands[cmd] = [0, 0.0, [0]*(len(LATENCY_BUCKETS_MS)+1)]
+        entry = self.commands[cmd]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2][bisect.bisect_left(LATENCY_BUCKETS_MS, seconds*1000.0)] += 1
+
+    def getReport(self, top=10):
+        '''
+        :return: list of lines summarizing the worst offenders
+        '''
+        lines = ["Counters:"]
+        for k in sorted(self.counters):
+            lines.append("- %s: %d" % (k, self.counters[k]))
+        lines.append("Slowest characters (evaluations, seconds, mean iterations, max iterations):")
+        for name in sorted(self.evals, key=lambda n: -self.evals[n][1])[:top]:
+            n, seconds, iters, maxiters = self.evals[name]
+            lines.append("- %s: %d, %.4fs, %.1f, %d" % (name, n, seconds, float(iters)/n, maxiters))
+        lines.append("Slowest files:")
+        for f in sorted(self.files, key=lambda f: -self.files[f])[:top]:
+            lines.append("- %s: %.4fs" % (f, self.files[f]))
+        lines.append("Commands (count, mean ms, histogram by ms):")
+        for cmd in sorted(self.commands, key=lambda c: -self.commands[c][1]):
+            n, seconds, buckets = self.commands[cmd]
+            hist = ", ".join("<%g:%d" % (bound, count) for bound, count in
+                             zip(LATENCY_BUCKETS_MS, buckets) if count>0)
+            if buckets[-1]>0:
+                hist += ", >%g:%d" % (LATENCY_BUCKETS_MS[-1], buckets[-1])
+            lines.append("- %s: %d, %.2f, %s" % (cmd, n, seconds*1000.0/n, hist))
+        return lines
+
+    def export(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"counters": self.counters,
+                       "evals": self.evals,
+                       "files": self.files,
+                       "commands": self.commands,
+                       "latency_buckets_ms": LATENCY_BUCKETS_MS}, f, indent=1)
+
+
+STATS = Stats()
@@ -0,0 +1,172 @@
+'''
+World nodes parsed from their files the first time they are needed
+'''
+from collections import OrderedDict
+
+# Parsed nodes kept before the least recently used are dropped
+LAZY_CACHE_SIZE = 4096
+
+
+# noinspection PyPep8Naming
+class LazyNodes(object):
+    def __init__(self, loader, scanner, maxloaded=LAZY_CACHE_SIZE):
+        '''
+        Stands in for the {name: WorldNode} dict of a World
+        :param loader: function (name, (filename, start, end)) -> linked WorldNode
+        :param scanner: function (filename, list of (name, start, end)) ->
+        {name: {direction: node name}}, reading transitions without building nodes
+        :param maxloaded: parsed nodes kept, nodes added directly are always kept
+        '''
+        self.loader = loader
+        self.scanner = scanner
+        self.maxloaded = maxloaded
+        # {name: (filename, start, end)}
+        self.index = {}
+        # {filename: names indexed from it}
+        self.files = {}
+        # {name: WorldNode}, least recently used first
+        self.loaded = OrderedDict()
+        # {name: WorldNode} added with __setitem__ rather than parsed
+        self.pinned = {}
+        # {filename: {name: {direction: node name}}} scanned by getTransitions
+        self.transitions = {}
+
+    def indexFile(self, filename, offsets):
+        '''
+        Replaces the index entries of filename, dropping nodes parsed from its old contents
+        :param offsets: list of (name, start, end) as returned by scanObjectOffsets
+        '''
+        self.transitions.pop(filename, None)
+        for name in self.files.pop(filename, ()):
+            if self.index.get(name, (None,))[0]==filename:
+                del self.index[name]
+                self.loaded.pop(name, None)
+        self.files[filename] = [name for (name, start, end) in offsets]
+        for (name, start, end) in offsets:
+            if name in self.index:
+                print("[!] Overwriting node "+name)
+            self.index[name] = (filename, start, end)
+            self.loaded.pop(name, None)
+            self.pinned.pop(name, None)
+
+    def getTransitions(self):
+        '''
+        :return: {name: {direction: node name}} for every node, scanning files rather
+        than parsing nodes, scans are kept until the file is indexed again
+        '''
+        result = {}
+        for filename in self.files:
+            names = [name for name in self.files[filename] if self.index.get(name, (None,))[0]==filename]
+            if filename not in self.transitions:
+                self.transitions[filename] = self.scanner(filename, [(name,)+self.index[name][1:]
+                                                                     for name in names])
+            for name in names:
+                result[name] = self.transitions[filename][name]
+        for name in self.pinned:
+            result[name] = self.pinned[name].dummy_nodes
+        return result
+
+    def getLoaded(self, name):
+        '''
+        :return: node if it is already parsed, otherwise None without parsing it
+        '''
+        if name in self.pinned:
+            return self.pinned[name]
+        return self.loaded.get(name)
+
+    def __getitem__(self, name):
+        if name in self.pinned:
+            return self.pinned[name]
+        node = self.loaded.pop(name, None)
+        if node is None:
+            node = self.loader(name, self.index[name])
+            if len(self.loaded)>=self.maxloaded:
+                self.loaded.popitem(last=False)
+        self.loaded[name] = node
+        return node
+
+    def get(self, name, default=None):
+        if name not in self:
+            return default
+        return self[name]
+
+    def __setitem__(self, name, node):
+        self.index.pop(name, None)
+        self.loaded.pop(name, None)
+        self.pinned[name] = node
+
+    def pop(self, name, default=None):
+        '''
+        Removes name without parsing it, its file may no longer match the index
+        :return: the node if it was parsed or added, otherwise default
+        '''
+        if name not in self:
+            return default
+        node = self.getLoaded(name)
+        if node is None:
+            node = default
+        self.index.pop(name, None)
+        self.loaded.pop(name, None)
+        self.pinned.pop(name, None)
+        return node
+
+    def __contains__(self, name):
+        return name in self.pinned or name in self.index
+
+    def __iter__(self):
+        for name in self.index:
+            yield name
+        for name in self.pinned:
+            if name not in self.index:
+                yield name
+
+    def __len__(self):
+        return len(self.index)+len([n for n in self.pinned if n not in self.index])
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[name] for name in list(self)]
+
+    def items(self):
+        return [(name, self[name]) for name in list(self)]
+
+
+# noinspection PyPep8Naming
+class LazyAdjacents(object):
+    __slots__ = ("world", "directions")
+
+    def __init__(self, world, directions):
+        '''
+        Stands in for WorldNode.adjacents, looking destinations up when followed
+        :param directions: {direction: node name}
+        '''
+        self.world = world
+        self.directions = directions
+
+    def __getitem__(self, direction):
+        return self.world.getNode(self.directions[direction])
+
+    def get(self, direction, default=None):
+        if direction not in self.directions:
+            return default
+        return self[direction]
+
+    def __contains__(self, direction):
+        return direction in self.directions
+
+    def __iter__(self):
+        return iter(self.directions)
+
+    def __len__(self):
+        return len(self.directions)
+
+    def keys(self):
+        return self.directions.keys()
+
+    def values(self):
+        return [self[d] for d in self.directions]
+
+    def items(self):
+        return [(d, self[d]) for d in self.directions]
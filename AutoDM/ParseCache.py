@@ -0,0 +1,132 @@
+'''
+Caches parsed DM objects of world files between runs
+'''
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+
+# Change whenever cached data changes shape so old entries are never loaded
+CACHE_FORMAT = "1"
+DEFAULT_CACHE_SIZE = 64*1024*1024
+CACHE_SUFFIX = ".dmcache"
+
+
+# noinspection PyPep8Naming
+class ParseCache(object):
+    def __init__(self, cachedir, maxsize=DEFAULT_CACHE_SIZE):
+        '''
+        :param cachedir: directory holding cache entries, created if missing
+        :param maxsize: bytes kept by prune, least recently used entries go first
+        '''
+        self.cachedir = cachedir
+        self.maxsize = maxsize
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+    def getKey(self, filename):
+        '''
+        :return: key identifying path and contents of filename
+        '''
+        h = hashlib.sha1(CACHE_FORMAT)
+        # marshal output is only readable by the same python version
+        h.update(sys.version)
+        h.update(os.path.abspath(filename))
+        h.update("\0")
+        with open(filename, "rb") as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def getStatKey(self, filename, kind):
+        '''
+        :param kind: name of the data cached for filename
+        :return: key identifying path, size and modification time of filename, cheaper
+        than getKey but missing edits which keep both
+        '''
+        st = os.stat(filename)
+        h = hashlib.sha1(CACHE_FORMAT)
+        h.update(sys.version)
+        h.update(kind+"\0"+os.path.abspath(filename)+"\0"+repr((st.st_mtime, st.st_size)))
+        return h.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.cachedir, key+CACHE_SUFFIX)
+
+    def has(self, key):
+        return os.path.exists(self.getPath(key))
+
+    def get(self, key):
+        '''
+        :return: cached data or None if not cached
+        '''
+        path = self.getPath(key)
+        try:
+            with open(path, "rb") as f:
+                data = marshal.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            print("[!] Discarding corrupt cache entry "+path)
+            self.remove(path)
+            return None
+        # Entry modification times order eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        '''
+        :param data: marshallable data, i.e. nested tuples, lists and strings
+        '''
+        fd, tmppath = tempfile.mkstemp(dir=self.cachedir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump(data, f)
+            os.rename(tmppath, self.getPath(key))
+        except (IOError, OSError) as e:
+            print("[!] Could not write cache entry: "+str(e))
+            self.remove(tmppath)
+
+    def getEntries(self):
+        '''
+        :return: list of (mtime, size, path) of cache entries, oldest first
+        '''
+        entries = []
+        for f in os.listdir(self.cachedir):
+            if f.endswith(CACHE_SUFFIX):
+                path = os.path.join(self.cachedir, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        return entries
+
+    def prune(self):
+        '''
+        Evicts least recently used entries until the cache fits in maxsize
+        '''
+        entries = self.getEntries()
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if total<=self.maxsize:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        '''
+        Invalidates every entry
+        '''
+        for (mtime, size, path) in self.getEntries():
+            self.remove(path)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,289 @@
+'''
+Immutable maps sharing structure between versions, so keeping every version is cheap
+'''
+
+BITS = 5
+MASK = (1 << BITS)-1
+# Hashes are taken as unsigned 64 bit integers, keys whose hashes agree in every bit
+# share a collision node
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS)-1
+
+# Marks a key missing from a node
+MISSING = object()
+
+
+# noinspection PyPep8Naming
+def popcount(x):
+    return bin(x).count("1")
+
+
+# noinspection PyPep8Naming
+class TrieNode(object):
+    __slots__ = ("bitmap", "children")
+
+    def __init__(self, bitmap, children):
+        '''
+        One level of a hash array mapped trie
+        :param bitmap: bit i set if a child holds hashes with the next BITS bits equal to i
+        :param children: tuple of children in bit order, each a TrieNode, CollisionNode
+        or (hash, key, value) leaf
+        '''
+        self.bitmap = bitmap
+        self.children = children
+
+    def find(self, h, shift, key):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit:
+            return MISSING
+        child = self.children[popcount(self.bitmap & (bit-1))]
+        if type(child) is tuple:
+            if child[0]==h and child[1]==key:
+                return child[2]
+            return MISSING
+        return child.find(h, shift+BITS, key)
+
+    def assoc(self, h, shift, key, value):
+        '''
+        :return: (node with key set to value, True if key was added rather than replaced),
+        self if key already had value
+        '''
+        bit = 1 << ((h >> shift) & MASK)
+        idx = popcount(self.bitmap & (bit-1))
+        if not self.bitmap & bit:
+            children = self.children[:idx]+((h, key, value),)+self.children[idx:]
+            return TrieNode(self.bitmap | bit, children), True
+        child = self.children[idx]
+        if type(child) is tuple:
+            if child[0]==h and child[1]==key:
+                if child[2] is value or child[2]==value:
+                    return self, False
+                newchild, added = (h, key, value), False
+            else:
+                newchild, added = makeNode(shift+BITS, child, (h, key, value)), True
+        else:
+            newchild, added = child.assoc(h, shift+BITS, key, value)
+            if newchild is child:
+                return self, False
+        return TrieNode(self.bitmap, self.children[:idx]+(newchild,)+self.children[idx+1:]), added
+
+    def without(self, h, shift, key):
+        '''
+        :return: node without key, self if key is missing, None if the node is left empty
+        '''
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit:
+            return self
+        idx = popcount(self.bitmap & (bit-1))
+        child = self.children[idx]
+        if type(child) is tuple:
+            if child[0]!=h or child[1]!=key:
+                return self
+            newchild = None
+        else:
+            newchild = child.without(h, shift+BITS, key)
+            if newchild is child:
+                return self
+            # A node left holding a single leaf is replaced by the leaf
+            if type(newchild) is TrieNode and len(newchild.children)==1 and \
+                    type(newchild.children[0]) is tuple:
+                newchild = newchild.children[0]
+        if newchild is None:
+            if len(self.children)==1:
+                return None
+            return TrieNode(self.bitmap & ~bit, self.children[:idx]+self.children[idx+1:])
+        return TrieNode(self.bitmap, self.children[:idx]+(newchild,)+self.children[idx+1:])
+
+    def leaves(self):
+        for child in self.children:
+            if type(child) is tuple:
+                yield child
+            else:
+                for leaf in child.leaves():
+                    yield leaf
+
+
+# noinspection PyPep8Naming
+class CollisionNode(object):
+    __slots__ = ("hash", "children")
+
+    def __init__(self, h, children):
+        '''
+        Leaves whose keys have equal hashes
+        :param children: tuple of (hash, key, value) leaves
+        '''
+        self.hash = h
+        self.children = children
+
+    def find(self, h, shift, key):
+        for leaf in self.children:
+            if leaf[1]==key:
+                return leaf[2]
+        return MISSING
+
+    def assoc(self, h, shift, key, value):
+        for i, leaf in enumerate(self.children):
+            if leaf[1]==key:
+                if leaf[2] is value or leaf[2]==value:
+                    return self, False
+                return CollisionNode(h, self.children[:i]+((h, key, value),)+self.children[i+1:]), False
+        return CollisionNode(h, self.children+((h, key, value),)), True
+
+    def without(self, h, shift, key):
+        for i, leaf in enumerate(self.children):
+            if leaf[1]==key:
+                children = self.children[:i]+self.children[i+1:]
+                if len(children)==1:
+                    return children[0]
+                return CollisionNode(h, children)
+        return self
+
+    def leaves(self):
+        return iter(self.children)
+
+
+# noinspection PyPep8Naming
+def makeNode(shift, a, b):
+    '''
+    :return: node holding leaves a and b, which have different keys
+    '''
+    if shift>=HASH_BITS:
+        return CollisionNode(a[0], (a, b))
+    abit = (a[0] >> shift) & MASK
+    bbit = (b[0] >> shift) & MASK
+    if abit==bbit:
+        return TrieNode(1 << abit, (makeNode(shift+BITS, a, b),))
+    if abit<bbit:
+        return TrieNode((1 << abit) | (1 << bbit), (a, b))
+    return TrieNode((1 << abit) | (1 << bbit), (b, a))
+
+
+EMPTY_NODE = TrieNode(0, ())
+
+
+# noinspection PyPep8Naming
+class PMap(object):
+    __slots__ = ("root", "size")
+
+    def __init__(self, root=EMPTY_NODE, size=0):
+        '''
+        Persistent map, set and delete return new maps sharing all unchanged nodes with
+        this one, in O(log n) time and memory
+        '''
+        self.root = root
+        self.size = size
+
+    def get(self, key, default=None):
+        val = self.root.find(hash(key) & HASH_MASK, 0, key)
+        if val is MISSING:
+            return default
+        return val
+
+    def set(self, key, value):
+        '''
+        :return: map with key set to value, this map if it already was
+        '''
+        root, added = self.root.assoc(hash(key) & HASH_MASK, 0, key, value)
+        if root is self.root:
+            return self
+        return PMap(root, self.size+1 if added else self.size)
+
+    def delete(self, key):
+        '''
+        :return: map without key, this map if key is missing
+        '''
+        root = self.root.without(hash(key) & HASH_MASK, 0, key)
+        if root is self.root:
+            return self
+        return PMap(EMPTY_NODE if root is None else root, self.size-1)
+
+    def update(self, items):
+        '''
+        :param items: iterable of (key, value)
+        :return: map with every key set
+        '''
+        m = self
+        for k, v in items:
+            m = m.set(k, v)
+        return m
+
+    def diff(self, other):
+        '''
+        Compares against another map, skipping nodes the two share
+        :return: list of (key, value here, value in other), None standing for a missing key
+        '''
+        changes = []
+        diffNodes(self.root, other.root, changes)
+        return changes
+
+    def __getitem__(self, key):
+        val = self.root.find(hash(key) & HASH_MASK, 0, key)
+        if val is MISSING:
+            raise KeyError(key)
+        return val
+
+    def __contains__(self, key):
+        return self.root.find(hash(key) & HASH_MASK, 0, key) is not MISSING
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for leaf in self.root.leaves():
+            yield leaf[1]
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(leaf[1], leaf[2]) for leaf in self.root.leaves()]
+
+    def __repr__(self):
+        return "PMap({"+", ".join(repr(k)+": "+repr(v) for k, v in self.items())+"})"
+
+
+# noinspection PyPep8Naming
+def diffNodes(a, b, changes):
+    '''
+    Appends (key, value in a, value in b) for every key whose value differs
+    :param a: TrieNode, CollisionNode, leaf or None
+    :param b: TrieNode, CollisionNode, leaf or None
+    '''
+    if a is b:
+        return
+    if type(a) is TrieNode and type(b) is TrieNode:
+        # Children are in bit order, so walk both in step from the lowest bit
+        bits = a.bitmap | b.bitmap
+        ia = ib = 0
+        while bits:
+            bit = bits & -bits
+            bits &= ~bit
+            achild = bchild = None
+            if a.bitmap & bit:
+                achild = a.children[ia]
+                ia += 1
+            if b.bitmap & bit:
+                bchild = b.children[ib]
+                ib += 1
+            if achild is not bchild:
+                diffNodes(achild, bchild, changes)
+        return
+    avals = dict((leaf[1], leaf[2]) for leaf in getLeaves(a))
+    bvals = dict((leaf[1], leaf[2]) for leaf in getLeaves(b))
+    for k in avals:
+        if k not in bvals:
+            changes.append((k, avals[k], None))
+        elif avals[k]!=bvals[k]:
+            changes.append((k, avals[k], bvals[k]))
+    for k in bvals:
+        if k not in avals:
+            changes.append((k, None, bvals[k]))
+
+
+# noinspection PyPep8Naming
+def getLeaves(node):
+    if node is None:
+        return ()
+    if type(node) is tuple:
+        return (node,)
+    return node.leaves()
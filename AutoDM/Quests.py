@@ -3,19 +3,72 @@ Contains classes managing questlines
 '''
 
 class Questline(object):
+    __slots__ = ("name", "curr_node", "start_node", "reach", "world", "quest_nodes")
+
     def __init__(self, name, start_node=None, quest_nodes=None):
-        self.name = name
+        self.name = intern(name)
         self.curr_node = start_node
+        self.start_node = start_node
+        # QuestReachability over quest_nodes, None until first needed
+        self.reach = None
+        # World notified of state changes, set by World.addQuestline
+        self.world = None
         self.quest_nodes = {}
         if quest_nodes==None:
             quest_nodes = []
         for n in quest_nodes:
             self.quest_nodes[n.val] = n
 
+    def fork(self):
+        '''
+        :return: questline sharing quest nodes with this one, progressing separately
+        '''
+        ql = Questline(self.name, self.curr_node)
+        ql.start_node = self.start_node
+        ql.quest_nodes = self.quest_nodes
+        ql.reach = self.reach
+        return ql
+
     def addQuestNode(self, val, node):
         if self.curr_node is None:
             self.curr_node = node
+            self.start_node = node
         self.quest_nodes[val] = node
+        self.reach = None
+
+    def getReachability(self):
+        if self.reach is None:
+            self.reach = QuestReachability(self.quest_nodes)
+        return self.reach
+
+    def canReach(self, val, fromval=None):
+        '''
+        :param val: quest value to reach
+        :param fromval: value to start from, the current value if None
+        :return: True if val can be reached through transitions, or is fromval
+        '''
+        if fromval is None:
+            fromval = self.currValue()
+        return self.getReachability().canReach(fromval, val)
+
+    def reachableFrom(self, fromval=None):
+        '''
+        :return: sorted quest values reachable in one or more transitions
+        '''
+        if fromval is None:
+            fromval = self.currValue()
+        return self.getReachability().reachableFrom(fromval)
+
+    def getReachReport(self):
+        '''
+        :return: (values unreachable from the start value, values without transitions,
+        list of (value, transition) to values which do not exist)
+        '''
+        reach = self.getReachability()
+        unreachable = []
+        if self.start_node is not None:
+            unreachable = reach.unreachableFrom(self.start_node.val)
+        return unreachable, reach.getTerminals(), reach.getMissing()
 
     def getQuestDescription(self, val):
         if val not in self.quest_nodes:
@@ -28,14 +81,20 @@ class Questline(object):
             print("[!] Given quest value not valid transition")
         elif val in self.quest_nodes:
             self.curr_node = self.quest_nodes[val]
+            self.stateChanged()
         else:
             print("[!] Given quest value does not exist")
     def force(self,val):
         if val in self.quest_nodes:
             self.curr_node = self.quest_nodes[val]
+            self.stateChanged()
         else:
             print("[!] Given quest value does not exist")
 
+    def stateChanged(self):
+        if self.world is not None:
+            self.world.stateChanged([self.name])
+
     def currValue(self):
         return self.curr_node.val
 
@@ -48,7 +107,64 @@ class Questline(object):
     def __repr__(self):
         return self.name+"{"+",".join([str(self.quest_nodes[qn]) for qn in self.quest_nodes])+"}"
 
+class QuestReachability(object):
+    __slots__ = ("vals", "bits", "missing", "direct", "reach")
+
+    def __init__(self, quest_nodes):
+        '''
+        Transitive closure of quest transitions, as one integer bitset per value
+        :param quest_nodes: {val: QuestNode}
+        '''
+        self.vals = sorted(quest_nodes)
+        self.bits = dict((val, i) for i, val in enumerate(self.vals))
+        self.missing = []
+        self.direct = []
+        for val in self.vals:
+            mask = 0
+            for t in quest_nodes[val].transitions:
+                if t in self.bits:
+                    mask |= 1 << self.bits[t]
+                else:
+                    self.missing.append((val, t))
+            self.direct.append(mask)
+        # Warshall's algorithm, reach[i] has bit j set if j is reachable from i
+        self.reach = list(self.direct)
+        for k in range(len(self.vals)):
+            bit = 1 << k
+            rk = self.reach[k]
+            for i in range(len(self.vals)):
+                if self.reach[i] & bit:
+                    self.reach[i] |= rk
+
+    def valsOf(self, mask):
+        return [val for i, val in enumerate(self.vals) if mask >> i & 1]
+
+    def canReach(self, fromval, val):
+        if fromval not in self.bits or val not in self.bits:
+            return False
+        return fromval==val or bool(self.reach[self.bits[fromval]] >> self.bits[val] & 1)
+
+    def reachableFrom(self, fromval):
+        if fromval not in self.bits:
+            return []
+        return self.valsOf(self.reach[self.bits[fromval]])
+
+    def unreachableFrom(self, fromval):
+        if fromval not in self.bits:
+            return list(self.vals)
+        i = self.bits[fromval]
+        return self.valsOf(~(self.reach[i] | 1 << i) & ((1 << len(self.vals))-1))
+
+    def getTerminals(self):
+        return [val for val, mask in zip(self.vals, self.direct) if mask==0]
+
+    def getMissing(self):
+        return list(self.missing)
+
+
 class QuestNode(object):
+    __slots__ = ("val", "transitions", "details")
+
     def __init__(self,val,details="NO DESC",transitions=None):
         '''
         :param val: Quest value of node
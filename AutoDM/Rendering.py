@@ -0,0 +1,88 @@
+'''
+Wrapping, caching and buffered output of text shown to players
+'''
+from collections import OrderedDict
+
+# Rendered descriptions kept per runner
+RENDER_CACHE_SIZE = 256
+
+
+# noinspection PyPep8Naming
+def wrapText(s, width, indent=""):
+    '''
+    Wraps words into lines of about width characters, each word preceded by a space
+    :param s: text, runs of whitespace are collapsed
+    :param width: characters per line before indent
+    :param indent: prefix of every line
+    :return: wrapped lines joined with newlines
+    '''
+    lines = []
+    words = []
+    length = 0
+    append = words.append
+    for word in s.split():
+        n = len(word)
+        if length+n>width:
+            lines.append(indent+" "+" ".join(words) if words else indent)
+            words = []
+            append = words.append
+            length = 0
+        append(word)
+        length += n+1
+    if len(words)>0:
+        lines.append(indent+" "+" ".join(words))
+    # A first line which is entirely empty is dropped
+    if len(lines)>1 and lines[0]=="":
+        del lines[0]
+    return "\n".join(lines)
+
+
+# noinspection PyPep8Naming
+class RenderCache(object):
+    def __init__(self, maxsize=RENDER_CACHE_SIZE):
+        '''
+        Least recently used rendered text, keyed by (node name, world version, width)
+        '''
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def put(self, key, entry):
+        if len(self.entries)>=self.maxsize:
+            self.entries.popitem(last=False)
+        self.entries[key] = entry
+
+    def clear(self):
+        self.entries.clear()
+
+
+# noinspection PyPep8Naming
+class OutputSink(object):
+    def __init__(self, send, flush=None):
+        '''
+        Collects output and sends it in one piece, so a slow terminal, file or socket is
+        written once per command rather than once per line
+        :param send: function taking a string, i.e. sys.stdout.write, a file's write,
+        socket.sendall or async_chat.push
+        :param flush: function called after sending, i.e. sys.stdout.flush
+        '''
+        self.send = send
+        self.sendflush = flush
+        self.pending = []
+
+    def write(self, s, end="\n"):
+        self.pending.append(s)
+        self.pending.append(end)
+
+    def flush(self):
+        if len(self.pending)==0:
+            return
+        data, self.pending = "".join(self.pending), []
+        self.send(data)
+        if self.sendflush is not None:
+            self.sendflush()
@@ -0,0 +1,92 @@
+'''
+Inverted index from words to the world objects whose text contains them
+'''
+import heapq
+import math
+import re
+
+TERM_RE = re.compile(r"[a-z0-9]+")
+
+
+# noinspection PyPep8Naming
+def getTerms(text):
+    '''
+    :return: list of normalized words in text
+    '''
+    return TERM_RE.findall(text.lower())
+
+
+# noinspection PyPep8Naming
+class TextIndex(object):
+    def __init__(self):
+        # {term: {key: occurrences}}
+        self.postings = {}
+        # {key: tuple of terms}, to remove a key without its old text
+        self.docs = {}
+
+    def add(self, key, texts):
+        '''
+        Indexes texts under key, replacing anything indexed under it before
+        :param key: hashable identifying the object, i.e. ("node", name)
+        :param texts: list of strings
+        '''
+        self.remove(key)
+        counts = {}
+        for text in texts:
+            for term in getTerms(text):
+                counts[term] = counts.get(term, 0)+1
+        if len(counts)==0:
+            return
+        self.docs[key] = tuple(counts)
+        for term in counts:
+            if term not in self.postings:
+                self.postings[term] = {}
+            self.postings[term][key] = counts[term]
+
+    def remove(self, key):
+        terms = self.docs.pop(key, None)
+        if terms is None:
+            return
+        for term in terms:
+            posting = self.postings[term]
+            del posting[key]
+            if len(posting)==0:
+                del self.postings[term]
+
+    def search(self, terms, matchall=True, limit=10):
+        '''
+        Ranks keys by the summed tf-idf of the terms they contain
+        :param terms: query strings, normalized like indexed text
+        :param matchall: only return keys containing every term, otherwise any term
+        :param limit: maximum number of results
+        :return: list of (score, key), best first
+        '''
+        terms = sorted(set(t for s in terms for t in getTerms(s)))
+        if len(terms)==0:
+            return []
+        postings = [self.postings.get(t, {}) for t in terms]
+        if matchall:
+            # Intersect starting from the rarest term
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if len(candidates)==0:
+                    return []
+        else:
+            candidates = set()
+            for posting in postings:
+                candidates.update(posting)
+        ndocs = float(len(self.docs))
+        scores = dict((key, 0.0) for key in candidates)
+        for posting in postings:
+            if len(posting)==0:
+                continue
+            idf = math.log(1.0+ndocs/len(posting))
+            for key in (posting if len(posting)<len(scores) else candidates):
+                if key in posting and key in scores:
+                    scores[key] += (1.0+math.log(posting[key]))*idf
+        return heapq.nlargest(limit, ((scores[k], k) for k in scores))
+
+    def __len__(self):
+        return len(self.docs)
@@ -1,10 +1,89 @@
 
+import itertools
+
+from LazyNodes import LazyNodes, LazyAdjacents
+from Persistent import PMap
+from TextIndex import TextIndex
+from WorldRoutes import RouteIndex
+
+# Shared by all worlds so a version number identifies a single world state
+STATE_VERSIONS = itertools.count(1)
+# World attributes derived from the hour
+TIME_ATTRS = ["hour", "day", "weekday"]
+
+
+# noinspection PyPep8Naming
+class WorldAttrs(object):
+    __slots__ = ("world",)
+
+    def __init__(self, world):
+        '''
+        Reads world attributes only, for evaluating conditions shared between characters
+        '''
+        self.world = world
+
+    def __getitem__(self, item):
+        attr = self.world.getWorldAttr(item)
+        if attr is not None: return attr
+        raise Exception("[!] Could not find "+item+" in world or local dictionaries")
+
+
+# noinspection PyPep8Naming
+class WorldState(object):
+    __slots__ = ("hour", "questvals", "dead")
+
+    def __init__(self, hour, questvals, dead):
+        '''
+        Snapshot of the changeable state of a World, see World.getState
+        :param questvals: PMap {quest name: value}
+        :param dead: PMap {name: True} of killed characters
+        '''
+        self.hour = hour
+        self.questvals = questvals
+        self.dead = dead
+
+    def atHour(self, hour):
+        return WorldState(hour, self.questvals, self.dead)
+
+    def sameAs(self, other):
+        '''
+        :return: True if other is known to hold the same state, the maps are only
+        compared by identity
+        '''
+        return self.hour==other.hour and self.questvals is other.questvals and \
+               self.dead is other.dead
+
+
 # noinspection PyPep8Naming
 class World(object):
     def __init__(self):
         self.questlines = {}
         self.hour = 0
         self.nodes = {}
+        self.characters = {}
+        # Bumped on every change to hour or quest state
+        self.version = next(STATE_VERSIONS)
+        # {character: (version it was added, attributes it reads)}, persistent like
+        # attrversions so forks share them rather than copying
+        self.charversions = PMap()
+        # {attribute name: version of its last change}
+        self.attrversions = PMap()
+        # Version of the last change to every attribute
+        self.allversion = self.version
+        # {node name: set of WorldNodes with a transition to it}
+        self.linkers = {}
+        # {node name: set of characters which may appear there}
+        self.residents = {}
+        self.routes = RouteIndex(self.nodes)
+        # Words in node, character and quest descriptions
+        self.textindex = TextIndex()
+        # {BinaryOp: result} of conditions shared between characters, for condkey
+        self.condresults = {}
+        self.condkey = None
+        # Persistent copies of quest values and killed characters, kept up to date so
+        # getState is O(1)
+        self.questvals = PMap()
+        self.dead = PMap()
 
     def getWorldAttr(self, name):
         if name == "hour":
@@ -17,15 +96,262 @@ class World(object):
             return self.questlines[name].currValue()
         return None
 
+    def evalShared(self, binop):
+        '''
+        Evaluates a condition reading only world attributes, once per world state
+        :param binop: interned BinaryOp
+        '''
+        results = self.getSharedResults()
+        if binop in results:
+            return results[binop]
+        result = binop.eval(WorldAttrs(self))
+        results[binop] = result
+        return result
+
+    def getSharedResults(self):
+        '''
+        :return: {BinaryOp: result} for the current world state
+        '''
+        # Scratch worlds have their hour set directly, without a new version
+        key = (self.version, self.hour)
+        if key!=self.condkey:
+            self.condresults = {}
+            self.condkey = key
+        return self.condresults
+
     def addWorldNode(self,node):
         if node.name in self.nodes:
             print "[!] Overwriting node "+node.name
         self.nodes[node.name] = node
+        self.routes.invalidate()
+        self.textindex.add(("node", node.name), [node.name, node.description])
 
     def addQuestline(self, questline):
         if questline.name in self.questlines:
             print("[!] Overwriting quest "+questline.name)
+            self.unindexQuestline(self.questlines[questline.name])
         self.questlines[questline.name] = questline
+        self.indexQuestline(questline)
+        questline.world = self
+        self.stateChanged([questline.name])
+
+    def indexQuestline(self, questline):
+        for val in questline.quest_nodes:
+            self.textindex.add(("quest", questline.name, val),
+                               [questline.name, questline.quest_nodes[val].getDetails()])
+
+    def unindexQuestline(self, questline):
+        for val in questline.quest_nodes:
+            self.textindex.remove(("quest", questline.name, val))
+
+    def find(self, terms, matchall=True, limit=10):
+        '''
+        Searches node, character and quest descriptions
+        :param terms: list of words
+        :param matchall: only return results containing every word
+        :return: list of keys, best first, each ("node", name), ("character", name) or
+        ("quest", quest name, value)
+        '''
+        return [key for score, key in self.textindex.search(terms, matchall, limit)]
+
+    def fork(self, quests=True):
+        '''
+        Makes a world sharing nodes and characters with this one, with its own hour and
+        quest values so it can be changed independently
+        :param quests: False to share questlines rather than copying them, for a scratch
+        world which only changes the hour
+        '''
+        w = World()
+        w.hour = self.hour
+        w.nodes = self.nodes
+        w.routes = self.routes
+        w.textindex = self.textindex
+        w.characters = self.characters
+        w.linkers = self.linkers
+        w.residents = self.residents
+        # Same state as this world, so cached evaluations remain valid
+        w.version = self.version
+        w.charversions = self.charversions
+        w.attrversions = self.attrversions
+        w.allversion = self.allversion
+        w.questvals = self.questvals
+        w.dead = self.dead
+        if not quests:
+            w.questlines = self.questlines
+            return w
+        for k in self.questlines:
+            ql = self.questlines[k].fork()
+            ql.world = w
+            w.questlines[k] = ql
+        return w
+
+    def addCharacter(self, character):
+        '''
+        Registers character so it is only re-evaluated when attributes it reads change
+        '''
+        name = character["NAME"]
+        if name in self.characters:
+            print("[!] Overwriting character "+name)
+            self.removeCharacter(self.characters[name])
+        self.characters[name] = character
+        self.contentChanged()
+        self.charversions = self.charversions.set(character, (self.version, tuple(character.getReads())))
+        self.textindex.add(("character", name), character.getTexts())
+        for n in character.nodes:
+            if n not in self.residents:
+                self.residents[n] = set()
+            self.residents[n].add(character)
+
+    def removeCharacter(self, character):
+        for n in character.nodes:
+            if n in self.residents:
+                self.residents[n].discard(character)
+        self.charversions = self.charversions.delete(character)
+        self.contentChanged()
+        if self.characters.get(character["NAME"]) is character:
+            del self.characters[character["NAME"]]
+            self.textindex.remove(("character", character["NAME"]))
+
+    def replaceCharacter(self, character):
+        '''
+        Swaps in character for the one with the same name, unlinking the old one from
+        its nodes and keeping whether it is alive
+        '''
+        old = self.getCharacter(character["NAME"])
+        if old is not None:
+            character.alive = old.alive
+            self.dropCharacter(old)
+        self.addCharacter(character)
+        character.linkPossibleNodes(self)
+
+    def dropCharacter(self, character):
+        '''
+        Removes character from the world and the nodes it is linked to
+        '''
+        self.removeCharacter(character)
+        for n in character.nodes:
+            # Nodes parsed later link from residents, which no longer hold character
+            node = self.getLoadedNode(n)
+            if node is not None:
+                node.removeCharacter(character)
+
+    def replaceWorldNode(self, node):
+        '''
+        Adds node, or moves its description and transitions into the existing node of
+        the same name so references to that node stay valid
+        :return: node now in the world
+        '''
+        self.contentChanged()
+        old = self.getNode(node.name)
+        if old is not None:
+            old.unlinkNodes(self)
+            old.setDescription(node.description)
+            self.textindex.add(("node", old.name), [old.name, old.description])
+            old.dummy_nodes = node.dummy_nodes
+            old.linkNodes(self)
+            return old
+        self.nodes[node.name] = node
+        self.textindex.add(("node", node.name), [node.name, node.description])
+        node.linkNodes(self)
+        for linker in list(self.linkers.get(node.name, ())):
+            linker.unlinkNodes(self)
+            linker.linkNodes(self)
+        for c in self.residents.get(node.name, ()):
+            node.addCharacter(c)
+        return node
+
+    def removeWorldNode(self, name, node=None):
+        '''
+        :param node: node previously under name, for lazy worlds which may have
+        unindexed it already
+        '''
+        node = self.nodes.pop(name, node)
+        self.contentChanged()
+        self.routes.invalidate()
+        self.textindex.remove(("node", name))
+        if node is None:
+            return
+        node.unlinkNodes(self)
+        for linker in list(self.linkers.get(name, ())):
+            linker.unlinkNodes(self)
+            linker.linkNodes(self)
+
+    def replaceQuestline(self, questline):
+        '''
+        Swaps in questline for the one with the same name, keeping its value if the new
+        questline still has it
+        '''
+        old = self.questlines.get(questline.name)
+        if old is not None and old.currValue() in questline.quest_nodes:
+            questline.curr_node = questline.quest_nodes[old.currValue()]
+        if old is not None:
+            self.unindexQuestline(old)
+        self.questlines[questline.name] = questline
+        self.indexQuestline(questline)
+        questline.world = self
+        self.stateChanged([questline.name])
+
+    def removeQuestline(self, name):
+        if name in self.questlines:
+            self.unindexQuestline(self.questlines[name])
+            del self.questlines[name]
+            self.stateChanged([name])
+
+    def getCharacter(self, name):
+        if name not in self.characters:
+            return None
+        else:
+            return self.characters[name]
+
+    def getEvalVersion(self, character):
+        '''
+        :return: version identifying the state of the attributes character reads
+        '''
+        entry = self.charversions.get(character)
+        # Unregistered characters could read anything
+        if entry is None:
+            return self.version
+        version, reads = entry
+        version = max(version, self.allversion)
+        for attr in reads:
+            version = max(version, self.attrversions.get(attr, 0))
+        return version
+
+    def route(self, a, b):
+        '''
+        :param a: name of starting node
+        :param b: name of destination node
+        :return: list of directions of a shortest route, None if there is none
+        '''
+        return self.routes.route(a, b)
+
+    def makeLazy(self, loader, scanner):
+        '''
+        Replaces nodes with LazyNodes parsing them on first use
+        :param loader: function (name, (filename, start, end)) -> WorldNode linked by
+        linkLazyNode
+        :param scanner: function (filename, list of (name, start, end)) ->
+        {name: {direction: node name}}
+        '''
+        self.nodes = LazyNodes(loader, scanner)
+        self.routes = RouteIndex(self.nodes)
+
+    def linkLazyNode(self, node):
+        '''
+        Links a node parsed on demand, its transitions are looked up when followed
+        '''
+        node.adjacents = LazyAdjacents(self, node.dummy_nodes)
+        for c in sorted(self.residents.get(node.name, ()), key=lambda c: c["NAME"]):
+            node.addCharacter(c)
+        self.textindex.add(("node", node.name), [node.name, node.description])
+
+    def getLoadedNode(self, nodename):
+        '''
+        Like getNode, but returns None rather than parsing a lazily loaded node
+        '''
+        if isinstance(self.nodes, LazyNodes):
+            return self.nodes.getLoaded(nodename)
+        return self.getNode(nodename)
 
     def getNode(self,nodename):
         if nodename not in self.nodes:
@@ -35,6 +361,130 @@ class World(object):
 
     def addHour(self, delta):
         self.hour += delta
+        if delta:
+            self.stateChanged(TIME_ATTRS)
+
+    def fastForward(self, hours, nodename=None):
+        '''
+        Advances the clock, finding when characters arrive at or leave a node from the
+        time thresholds in their conditions rather than by evaluating every hour
+        :param hours: hours to advance by
+        :param nodename: node to report events for
+        :return: list of (hour, "arrive" or "leave", name, desc) sorted by hour
+        '''
+        events = []
+        node = self.getNode(nodename)
+        if node is not None and hours>0:
+            start = self.hour
+            # Quest values are fixed while fast-forwarding, made on the first change
+            scratch = None
+            for c in node.possibleCharacters:
+                if not c.alive:
+                    continue
+                changes = c.getChangeHours(start, start+hours)
+                if len(changes)==0:
+                    continue
+                here = c.getPresence(self)[0]==nodename
+                if scratch is None:
+                    scratch = self.fork(quests=False)
+                for h in changes:
+                    scratch.hour = h
+                    presence = c.computePresence(scratch)
+                    if (presence[0]==nodename)!=here:
+                        here = not here
+                        events.append((h, "arrive" if here else "leave", presence[1], presence[2]))
+            events.sort(key=lambda e: e[0])
+        self.addHour(hours)
+        return events
+
+    def stateChanged(self, attrs=None):
+        '''
+        Invalidates anything cached against the current world state
+        :param attrs: names of changed attributes, None if anything may have changed
+        '''
+        self.version = next(STATE_VERSIONS)
+        if attrs is None:
+            self.allversion = self.version
+            self.questvals = PMap()
+            self.recordQuestValues(self.questlines)
+        else:
+            self.attrversions = self.attrversions.update((attr, self.version) for attr in attrs)
+            self.recordQuestValues(attrs)
+
+    def recordQuestValues(self, names):
+        '''
+        Copies the values of any quests among names into questvals
+        '''
+        for name in names:
+            ql = self.questlines.get(name)
+            if ql is not None and ql.curr_node is not None:
+                self.questvals = self.questvals.set(name, ql.currValue())
+            else:
+                self.questvals = self.questvals.delete(name)
+
+    def killCharacter(self, character):
+        character.kill()
+        self.dead = self.dead.set(character["NAME"], True)
+        self.contentChanged()
+
+    def reviveCharacter(self, character):
+        character.alive = True
+        character.invalidate()
+        self.dead = self.dead.delete(character["NAME"])
+        self.contentChanged()
+
+    def getState(self):
+        '''
+        :return: WorldState sharing structure with the world, taken in O(1)
+        '''
+        return WorldState(self.hour, self.questvals, self.dead)
+
+    def setState(self, state):
+        '''
+        Returns to a state from getState, changing only what differs from it
+        :return: (list of (quest name, value) changed, list of (character name, alive)
+        changed)
+        '''
+        changed = []
+        quests = []
+        complete = True
+        for name, current, val in self.questvals.diff(state.questvals):
+            ql = self.questlines.get(name)
+            if val is None or ql is None or val not in ql.quest_nodes:
+                # Quests added or edited since state was taken keep their values
+                complete = False
+                continue
+            ql.curr_node = ql.quest_nodes[val]
+            changed.append(name)
+            quests.append((name, val))
+        characters = []
+        for name, current, dead in self.dead.diff(state.dead):
+            character = self.getCharacter(name)
+            if character is None:
+                complete = False
+            elif dead:
+                self.killCharacter(character)
+                characters.append((name, False))
+            else:
+                self.reviveCharacter(character)
+                characters.append((name, True))
+        if self.hour!=state.hour:
+            self.hour = state.hour
+            changed += TIME_ATTRS
+        if changed:
+            self.stateChanged(changed)
+        if complete:
+            # Equal to the maps of state, sharing them keeps later comparisons O(1)
+            self.questvals = state.questvals
+            self.dead = state.dead
+        return quests, characters
+
+    def contentChanged(self):
+        '''
+        Starts a new version for a change to nodes or characters rather than to attributes,
+        so anything rendered against the old version is not reused
+        '''
+        self.version = next(STATE_VERSIONS)
 
     def addQuestState(self, quest, val=0):
         if quest in self.questlines:
@@ -53,14 +503,19 @@ class World(object):
 
 # noinspection PyPep8Naming
 class WorldNode(object):
+    __slots__ = ("name", "adjacents", "possibleCharacters", "characterset", "description",
+                 "dummy_nodes")
+
     def __init__(self, name, description="NO DESC"):
         '''
         :param name: name of node
         :param description: {"direction":WorldNode}
         '''
-        self.name = name
+        self.name = intern(name)
         self.adjacents = {}
+        # Characters in the order they were linked, and the same as a set
         self.possibleCharacters = []
+        self.characterset = set()
         self.description = description
         self.dummy_nodes = {}
 
@@ -74,7 +529,7 @@ class WorldNode(object):
         '''
         if direction in self.dummy_nodes:
             print "[!] Overwriting direction "+direction
-        self.dummy_nodes[direction] = nodename
+        self.dummy_nodes[intern(direction)] = intern(nodename)
 
     def linkNodes(self, world):
         '''
@@ -84,6 +539,22 @@ class WorldNode(object):
         for d in self.dummy_nodes:
             n = self.dummy_nodes[d]
             self.addNode(d,world.getNode(n))
+            if n not in world.linkers:
+                world.linkers[n] = set()
+            world.linkers[n].add(self)
+        world.routes.invalidate()
+
+    def unlinkNodes(self, world):
+        '''
+        Reverses linkNodes
+        :param world: World the node was linked in
+        '''
+        for d in self.dummy_nodes:
+            n = self.dummy_nodes[d]
+            if n in world.linkers:
+                world.linkers[n].discard(self)
+        self.adjacents = {}
+        world.routes.invalidate()
 
     def addNode(self, direction, node):
         if direction in self.adjacents:
@@ -91,15 +562,22 @@ class WorldNode(object):
         self.adjacents[direction] = node
 
     def addCharacter(self, character):
-        if character in self.possibleCharacters:
-            print "[!] Duplicating character "+character.name
+        if character in self.characterset:
+            print "[!] Duplicating character "+character["NAME"]
+            return
+        self.characterset.add(character)
         self.possibleCharacters.append(character)
 
+    def removeCharacter(self, character):
+        if character in self.characterset:
+            self.characterset.discard(character)
+            self.possibleCharacters.remove(character)
+
     def getActiveCharacters(self,world):
         chars = []
         for c in self.possibleCharacters:
             if c.alive:
-                eval_dict = c.getEvalDict(world)
-                if eval_dict["NODE"]==self.name:
-                    chars.append((c,eval_dict["NAME"],eval_dict["DESC"]))
+                node, name, desc = c.getPresence(world)
+                if node==self.name:
+                    chars.append((c,name,desc))
         return chars
\ No newline at end of file
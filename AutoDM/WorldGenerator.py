@@ -0,0 +1,144 @@
+'''
+Writes synthetic worlds in the world file format for benchmarking
+'''
+import os
+import random
+import sys
+
+from AutoDM import parseOptions
+
+WORDS = ["old", "dark", "quiet", "busy", "ancient", "narrow", "grand", "ruined", "damp",
+         "bright", "hidden", "crowded", "stone", "wooden", "misty", "golden", "cold",
+         "market", "temple", "bridge", "tower", "cellar", "garden", "forge", "harbor",
+         "library", "alley", "square", "gate", "mill", "inn", "shrine", "barracks"]
+
+
+# noinspection PyPep8Naming
+class WorldGenerator(object):
+    def __init__(self, nodes=100, degree=3, characters=200, depth=2, rerun=0.1,
+                 quests=10, questlength=5, files=10, seed=0):
+        '''
+        :param nodes: number of world nodes, besides start
+        :param degree: TRANS edges per node, at least 2 for the ring keeping nodes connected
+        :param characters: number of characters
+        :param depth: nesting depth of conditional evals
+        :param rerun: fraction of characters with an eval calling RERUN
+        :param quests: number of questlines
+        :param questlength: number of nodes per questline
+        :param files: number of files nodes and characters are each split into
+        :param seed: random seed, equal parameters and seed give equal worlds
+        '''
+        self.nnodes = nodes
+        self.degree = degree
+        self.ncharacters = characters
+        self.depth = depth
+        self.rerun = rerun
+        self.nquests = quests
+        self.questlength = questlength
+        self.nfiles = max(1, files)
+        self.rand = random.Random(seed)
+
+    def generate(self, path):
+        '''
+        Writes world directory with quests/, characters/ and world/ subdirectories
+        :param path: directory to write into, created if missing
+        '''
+        for d in ["quests", "characters", "world"]:
+            dirpath = os.path.join(path, d)
+            if not os.path.isdir(dirpath):
+                os.makedirs(dirpath)
+        self.writeSplit(os.path.join(path, "quests"), "quests",
+                        [self.makeQuest(i) for i in range(self.nquests)], 1)
+        self.writeSplit(os.path.join(path, "world"), "nodes",
+                        [self.makeStart()]+[self.makeNode(i) for i in range(self.nnodes)], self.nfiles)
+        self.writeSplit(os.path.join(path, "characters"), "characters",
+                        [self.makeCharacter(i) for i in range(self.ncharacters)], self.nfiles)
+
+    def writeSplit(self, dirpath, prefix, objects, nfiles):
+        per_file = max(1, (len(objects)+nfiles-1)//nfiles)
+        for n, i in enumerate(range(0, len(objects), per_file)):
+            with open(os.path.join(dirpath, prefix+"_"+str(n)+".txt"), "w") as f:
+                f.write("\n".join(objects[i:i+per_file]))
+
+    def makeText(self, n):
+        return " ".join(self.rand.choice(WORDS) for _ in range(n))
+
+    def makeStart(self):
+        return "start {\n    \"Setup location\",\n    TRANS {\n        \"into the world\" = node_0,\n    },\n}\n"
+
+    def makeNode(self, i):
+        lines = ["node_%d {" % i,
+                 "    \"The %s\"," % self.makeText(8),
+                 "    TRANS {"]
+        if self.nnodes>1:
+            lines.append("        next = node_%d," % ((i+1) % self.nnodes))
+            lines.append("        back = node_%d," % ((i-1) % self.nnodes))
+        for k in range(self.degree-2):
+            lines.append("        \"path %d\" = node_%d," % (k, self.rand.randrange(self.nnodes)))
+        lines += ["    },", "}", ""]
+        return "\n".join(lines)
+
+    def makeQuest(self, i):
+        lines = ["quest_%d {" % i]
+        for val in range(1, self.questlength+1):
+            lines.append("    %d {" % val)
+            lines.append("        \"Step %d of %s\"," % (val, self.makeText(4)))
+            if val<self.questlength:
+                lines.append("        %d : \"Continue\"," % (val+1))
+                skip = self.rand.randint(val+1, self.questlength)
+                if skip!=val+1:
+                    lines.append("        %d : \"Skip ahead\"," % skip)
+            lines.append("    },")
+        lines += ["}", ""]
+        return "\n".join(lines)
+
+    def makeCondition(self):
+        kind = self.rand.random()
+        if kind<0.5 or self.nquests==0:
+            start = self.rand.randrange(24)
+            end = self.rand.randint(start+1, 24)
+            return "(%d<=hour) and (hour<%d)" % (start, end)
+        elif kind<0.7:
+            return "(weekday < %d) and (%d <= hour)" % (self.rand.randint(1, 7), self.rand.randrange(24))
+        quest = self.rand.randrange(self.nquests)
+        return "(quest_%d > %d) and (hour < %d)" % (quest, self.rand.randrange(self.questlength),
+                                                   self.rand.randint(1, 24))
+
+    def makeEvals(self, indent, depth):
+        lines = []
+        for _ in range(self.rand.randint(1, 3)):
+            lines.append(indent+"\"%s\" {" % self.makeCondition())
+            if self.rand.random()<0.5:
+                lines.append(indent+"    NODE = node_%d," % self.rand.randrange(self.nnodes))
+            lines.append(indent+"    DESC = \"%s\"," % self.makeText(6))
+            if depth>1:
+                lines += self.makeEvals(indent+"    ", depth-1)
+            lines.append(indent+"},")
+        return lines
+
+    def makeCharacter(self, i):
+        lines = ["\"Character %d\" {" % i,
+                 "    DESC = \"%s\"," % self.makeText(6),
+                 "    NODE = node_%d," % self.rand.randrange(self.nnodes)]
+        if self.depth>0:
+            lines += self.makeEvals("    ", self.depth)
+        if self.rand.random()<self.rerun:
+            # Converges after one rerun, STATE and DONE are only compared as strings
+            lines += ["    STATE = a,",
+                      "    DONE = m,",
+                      "    \"STATE < DONE\" {",
+                      "        STATE = z,",
+                      "        RERUN,",
+                      "    },"]
+        lines += ["}", ""]
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    args, options = parseOptions(sys.argv)
+    if len(args)!=2:
+        print("CLI usage: python WorldGenerator.py [path] [--nodes=N] [--degree=N] [--characters=N]")
+        print("          [--depth=N] [--rerun=F] [--quests=N] [--questlength=N] [--files=N] [--seed=N]")
+    else:
+        params = dict((k, float(v) if k=="rerun" else int(v)) for k, v in options.items())
+        WorldGenerator(**params).generate(args[1])
@@ -0,0 +1,135 @@
+'''
+Shortest routes between world nodes
+'''
+import array
+from collections import deque
+
+from LazyNodes import LazyNodes
+
+# Worlds with at most this many nodes get next hops to every node precomputed
+ALL_PAIRS_MAX_NODES = 300
+# Routing trees kept for larger worlds, one per destination
+ROUTE_CACHE_SIZE = 64
+
+
+# noinspection PyPep8Naming
+class RouteIndex(object):
+    def __init__(self, nodes):
+        '''
+        Built lazily from the linked node graph, call invalidate when it changes
+        :param nodes: {name: WorldNode}, shared with the world so changes are seen
+        '''
+        self.nodes = nodes
+        self.invalidate()
+
+    def invalidate(self):
+        self.names = None
+        # {name: id}
+        self.ids = None
+        # id -> list of (direction, id) sorted by direction
+        self.edges = None
+        # id -> list of (id, edge index) with an edge into it
+        self.reverse = None
+        # id -> weakly connected component id
+        self.components = None
+        # {destination id: array of edge index to take from each id, -1 if none}
+        self.trees = {}
+        # {destination id: last use}, for evicting trees
+        self.used = {}
+        self.uses = 0
+
+    def build(self):
+        if isinstance(self.nodes, LazyNodes):
+            # Scanned from the files, so lazily parsed nodes are not parsed
+            alltransitions = self.nodes.getTransitions()
+        else:
+            alltransitions = dict((name, self.nodes[name].dummy_nodes) for name in self.nodes)
+        self.names = sorted(alltransitions)
+        self.ids = dict((name, i) for i, name in enumerate(self.names))
+        self.edges = []
+        self.reverse = [[] for _ in self.names]
+        for i, name in enumerate(self.names):
+            transitions = alltransitions[name]
+            out = []
+            for d in sorted(transitions):
+                if transitions[d] in self.ids:
+                    out.append((d, self.ids[transitions[d]]))
+            for idx, (d, j) in enumerate(out):
+                self.reverse[j].append((i, idx))
+            self.edges.append(out)
+        self.components = self.buildComponents()
+        if len(self.names)<=ALL_PAIRS_MAX_NODES:
+            for i in range(len(self.names)):
+                self.trees[i] = self.buildTree(i)
+
+    def buildComponents(self):
+        '''
+        :return: array of component ids, nodes in different components have no route
+        '''
+        components = array.array("i", [-1])*len(self.names)
+        for start in range(len(self.names)):
+            if components[start]!=-1:
+                continue
+            components[start] = start
+            queue = [start]
+            while queue:
+                i = queue.pop()
+                for d, j in self.edges[i]:
+                    if components[j]==-1:
+                        components[j] = start
+                        queue.append(j)
+                for j, idx in self.reverse[i]:
+                    if components[j]==-1:
+                        components[j] = start
+                        queue.append(j)
+        return components
+
+    def buildTree(self, dest):
+        '''
+        Breadth first search backwards from dest
+        :return: array of the edge index leading one step closer to dest from each node
+        '''
+        tree = array.array("i", [-1])*len(self.names)
+        queue = deque([dest])
+        while queue:
+            j = queue.popleft()
+            for i, idx in self.reverse[j]:
+                if tree[i]==-1 and i!=dest:
+                    tree[i] = idx
+                    queue.append(i)
+        return tree
+
+    def getTree(self, dest):
+        self.uses += 1
+        self.used[dest] = self.uses
+        tree = self.trees.get(dest)
+        if tree is None:
+            if len(self.trees)>=ROUTE_CACHE_SIZE:
+                oldest = min(self.trees, key=lambda k: self.used[k])
+                del self.trees[oldest]
+                del self.used[oldest]
+            tree = self.buildTree(dest)
+            self.trees[dest] = tree
+        return tree
+
+    def route(self, a, b):
+        '''
+        :param a: name of starting node
+        :param b: name of destination node
+        :return: list of directions of a shortest route, None if there is none
+        '''
+        if self.ids is None:
+            self.build()
+        if a not in self.ids or b not in self.ids:
+            return None
+        i, dest = self.ids[a], self.ids[b]
+        if self.components[i]!=self.components[dest]:
+            return None
+        tree = self.getTree(dest)
+        directions = []
+        while i!=dest:
+            if tree[i]==-1:
+                return None
+            d, i = self.edges[i][tree[i]]
+            directions.append(d)
+        return directions
@@ -0,0 +1,126 @@
+'''
+Session persistence as a snapshot of world state plus a journal of changes since
+'''
+import json
+import os
+
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_FILE = "journal.log"
+# Journal entries written before the snapshot is rewritten
+COMPACT_EVERY = 1000
+
+
+# noinspection PyPep8Naming
+class WorldSave(object):
+    def __init__(self, savepath, compact_every=COMPACT_EVERY):
+        '''
+        :param savepath: directory holding the snapshot and journal
+        :param compact_every: journal length at which needsCompaction becomes true
+        '''
+        self.savepath = savepath
+        self.compact_every = compact_every
+        self.snapshotpath = os.path.join(savepath, SNAPSHOT_FILE)
+        self.journalpath = os.path.join(savepath, JOURNAL_FILE)
+        self.journal = None
+        self.entries = 0
+        if not os.path.isdir(savepath):
+            os.makedirs(savepath)
+
+    def exists(self):
+        return os.path.exists(self.snapshotpath) or os.path.exists(self.journalpath)
+
+    def makeSnapshot(self, world, nodename):
+        '''
+        :return: dict of the state of world and the player location
+        '''
+        return {"hour": world.hour,
+                "quests": dict((k, world.questlines[k].currValue()) for k in world.questlines
+                               if world.questlines[k].curr_node is not None),
+                "dead": sorted(k for k in world.characters if not world.characters[k].alive),
+                "node": nodename}
+
+    def saveSnapshot(self, world, nodename):
+        '''
+        Writes a full snapshot and empties the journal
+        '''
+        tmppath = self.snapshotpath+".tmp"
+        with open(tmppath, "w") as f:
+            json.dump(self.makeSnapshot(world, nodename), f)
+        os.rename(tmppath, self.snapshotpath)
+        self.close()
+        open(self.journalpath, "w").close()
+        self.entries = 0
+
+    def record(self, entry):
+        '''
+        Appends a change to the journal
+        :param entry: dict with one or more of the keys
+        hour: new hour, quest and val: new quest value, node: player location,
+        dead: name of killed character, alive: name of revived character
+        '''
+        if self.journal is None:
+            self.journal = open(self.journalpath, "a")
+        self.journal.write(json.dumps(entry)+"\n")
+        self.journal.flush()
+        self.entries += 1
+
+    def needsCompaction(self):
+        return self.entries>=self.compact_every
+
+    def load(self, world):
+        '''
+        Restores world from the snapshot and replays the journal
+        :return: name of the saved player location, None if none was saved
+        '''
+        nodename = None
+        if os.path.exists(self.snapshotpath):
+            with open(self.snapshotpath) as f:
+                snapshot = json.load(f)
+            world.hour = snapshot["hour"]
+            world.stateChanged()
+            for k in snapshot["quests"]:
+                self.applyEntry(world, {"quest": k, "val": snapshot["quests"][k]})
+            for k in snapshot["dead"]:
+                self.applyEntry(world, {"dead": k})
+            nodename = snapshot["node"]
+        self.entries = 0
+        if os.path.exists(self.journalpath):
+            with open(self.journalpath) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partially written last line
+                        print("[!] Skipping corrupt journal entry")
+                        continue
+                    self.applyEntry(world, entry)
+                    if "node" in entry:
+                        nodename = entry["node"]
+                    self.entries += 1
+        return nodename
+
+    def applyEntry(self, world, entry):
+        if "hour" in entry:
+            world.addHour(entry["hour"]-world.hour)
+        if "quest" in entry:
+            if entry["quest"] in world.questlines:
+                world.questlines[entry["quest"]].force(entry["val"])
+            else:
+                print("[!] No quest "+entry["quest"])
+        if "dead" in entry:
+            character = world.getCharacter(entry["dead"])
+            if character is not None:
+                world.killCharacter(character)
+            else:
+                print("[!] No character "+entry["dead"])
+        if "alive" in entry:
+            character = world.getCharacter(entry["alive"])
+            if character is not None:
+                world.reviveCharacter(character)
+            else:
+                print("[!] No character "+entry["alive"])
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
@@ -0,0 +1,56 @@
+'''
+Polls world files for changes and reloads them into a running world
+'''
+import os
+import time
+
+from DMParser import listSourceFiles
+
+
+# noinspection PyPep8Naming
+class WorldWatcher(object):
+    def __init__(self, parser, world, interval=1.0):
+        '''
+        :param parser: WorldParser which parsed world
+        :param world: World to update
+        :param interval: minimum seconds between scans of the world directory
+        '''
+        self.parser = parser
+        self.world = world
+        self.interval = interval
+        self.lastpoll = time.time()
+        self.mtimes = self.scan()
+
+    def scan(self):
+        '''
+        :return: {filename: (mtime, size)} for all world files
+        '''
+        mtimes = {}
+        for kind, root in self.parser.getSourceRoots():
+            if not os.path.exists(root):
+                continue
+            for f in listSourceFiles(root):
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                mtimes[f] = (st.st_mtime, st.st_size)
+        return mtimes
+
+    def poll(self, force=False):
+        '''
+        Reloads files changed, added or deleted since the last poll
+        :param force: scan even if interval has not passed
+        :return: sorted list of reloaded files
+        '''
+        now = time.time()
+        if not force and now-self.lastpoll<self.interval:
+            return []
+        self.lastpoll = now
+        mtimes = self.scan()
+        changed = sorted(f for f in set(mtimes).union(self.mtimes)
+                         if mtimes.get(f)!=self.mtimes.get(f))
+        self.mtimes = mtimes
+        if len(changed)>0:
+            self.parser.reloadFiles(self.world, changed)
+        return changed
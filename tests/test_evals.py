@@ -0,0 +1,75 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDM"))
+
+from DMParser import WorldParser
+from WorldGenerator import WorldGenerator
+
+EXAMPLE_WORLD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ExampleWorld")
+# Conditions whose right operand raises, and whose left operand decides the result
+RAISING_CHARACTERS = '''
+"And Missing" {
+    NODE = example_home,
+    DESC = "none",
+    "(hour<0) and (missing<3)" {
+        DESC = "never",
+    },
+}
+
+"Or Missing" {
+    NODE = example_home,
+    DESC = "none",
+    "(hour>=0) or ((missing+1)<3)" {
+        DESC = "always",
+    },
+}
+'''
+
+
+def outcome(character, world):
+    '''
+    :return: evaluated characteristics, or the message of what evaluating them raised
+    '''
+    try:
+        return sorted(character.runEvals(world)[0].items())
+    except Exception as e:
+        return "raised "+str(e)
+
+
+class CompiledEvalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compare(self, world, hours):
+        for h in range(hours):
+            world.addHour(1)
+            for c in world.characters.values():
+                self.assertTrue(c.compiled is not None)
+                # Separate forks so neither reuses conditions the other shared
+                compiled = outcome(c, world.fork())
+                c.compiled, function = None, c.compiled
+                interpreted = outcome(c, world.fork())
+                c.compiled = function
+                self.assertEqual(compiled, interpreted, c["NAME"])
+
+    def testGeneratedWorld(self):
+        WorldGenerator(nodes=10, characters=200, rerun=0.3, depth=3, seed=2).generate(self.dir)
+        self.compare(WorldParser(self.dir).parse(), 30)
+
+    def testRaisingOperands(self):
+        path = os.path.join(self.dir, "world")
+        shutil.copytree(EXAMPLE_WORLD, path)
+        with open(os.path.join(path, "characters", "characters.txt"), "a") as f:
+            f.write(RAISING_CHARACTERS)
+        self.compare(WorldParser(path).parse(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
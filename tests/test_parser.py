@@ -0,0 +1,86 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDM"))
+
+import DMParser
+from DMParser import DMObjectParser
+
+EXAMPLE_WORLD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ExampleWorld")
+
+
+def readExampleWorld():
+    texts = []
+    for dirname, dirs, files in sorted(os.walk(EXAMPLE_WORLD)):
+        for f in sorted(files):
+            with open(os.path.join(dirname, f)) as fp:
+                texts.append(fp.read())
+    return "".join(texts)
+
+
+def corrupt(rand, text):
+    chars = list(text)
+    for i in range(rand.randint(1, 4)):
+        pos = rand.randrange(len(chars)+1)
+        if rand.random()<0.5:
+            chars.insert(pos, rand.choice('{}",=#\n x'))
+        elif pos<len(chars):
+            del chars[pos]
+    return "".join(chars)
+
+
+def outcome(f):
+    '''
+    :return: repr of the result of f, or the type and message of what it raised
+    '''
+    try:
+        return repr(f())
+    except Exception as e:
+        return "raised "+type(e).__name__+": "+str(e)
+
+
+class StreamingParserTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "objects.txt")
+        self.parser = DMObjectParser()
+        self.chunkbytes = DMParser.STREAM_CHUNK_BYTES
+        # Small enough that every file is cut into several chunks
+        DMParser.STREAM_CHUNK_BYTES = 40
+
+    def tearDown(self):
+        DMParser.STREAM_CHUNK_BYTES = self.chunkbytes
+        shutil.rmtree(self.dir)
+
+    def compare(self, text):
+        with open(self.filename, "w") as f:
+            f.write(text)
+        whole = outcome(lambda: self.parser.parseFile(self.filename))
+        streamed = outcome(lambda: list(self.parser.iterFileObjects(self.filename)))
+        self.assertEqual(whole, streamed, text)
+
+    def testExampleWorld(self):
+        self.compare(readExampleWorld())
+
+    def testMalformed(self):
+        for text in ['a { "x", }\n}\nb { "y", }\n',
+                     'a { "x", }\n junk b { "y", }\n',
+                     'a { "x", }\njunk\n',
+                     'a { "x", }\nb { "y",\n',
+                     'a { "x }", }\nb { "y", }\n',
+                     'a { b = }, }\nc { "y", }\n']:
+            self.compare(text)
+
+    def testFuzzAgainstParseFile(self):
+        text = readExampleWorld()
+        rand = random.Random(0)
+        for i in range(1000):
+            self.compare(corrupt(rand, text))
+
+
+if __name__ == "__main__":
+    unittest.main()
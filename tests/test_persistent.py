@@ -0,0 +1,86 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDM"))
+
+from Persistent import PMap
+
+
+class CollidingKey(object):
+    '''
+    Key whose hash is shared by every key with the same bucket
+    '''
+    def __init__(self, value, bucket):
+        self.value = value
+        self.bucket = bucket
+
+    def __hash__(self):
+        return self.bucket
+
+    def __eq__(self, other):
+        return isinstance(other, CollidingKey) and self.value==other.value
+
+    def __ne__(self, other):
+        return not self==other
+
+    def __repr__(self):
+        return "CollidingKey(%r, %r)" % (self.value, self.bucket)
+
+
+def dictDiff(a, b):
+    changes = set()
+    for k in set(a) | set(b):
+        if a.get(k)!=b.get(k):
+            changes.add((k, a.get(k), b.get(k)))
+    return changes
+
+
+class PMapTest(unittest.TestCase):
+    def check(self, pmap, reference):
+        self.assertEqual(len(pmap), len(reference))
+        self.assertEqual(dict(pmap.items()), reference)
+        self.assertEqual(sorted(pmap, key=repr), sorted(reference, key=repr))
+        for k in reference:
+            self.assertTrue(k in pmap)
+            self.assertEqual(pmap[k], reference[k])
+
+    def randomOps(self, rand, keys):
+        pmap, reference = PMap(), {}
+        versions = [(pmap, dict(reference))]
+        for i in range(3000):
+            k = rand.choice(keys)
+            if rand.random()<0.6:
+                v = rand.randint(0, 5)
+                pmap = pmap.set(k, v)
+                reference[k] = v
+            else:
+                self.assertEqual(pmap.get(k, "missing"), reference.get(k, "missing"))
+                pmap = pmap.delete(k)
+                reference.pop(k, None)
+            versions.append((pmap, dict(reference)))
+        # Every older version is unchanged by later ones
+        for pmap, reference in versions[::50]:
+            self.check(pmap, reference)
+        for i in range(200):
+            (a, ra), (b, rb) = rand.choice(versions), rand.choice(versions)
+            self.assertEqual(set(a.diff(b)), dictDiff(ra, rb))
+
+    def testRandomOps(self):
+        rand = random.Random(0)
+        self.randomOps(rand, range(200)+["k%d" % i for i in range(200)])
+
+    def testCollisions(self):
+        rand = random.Random(1)
+        self.randomOps(rand, [CollidingKey(i, i%7) for i in range(60)])
+
+    def testUnchangedReturnsSelf(self):
+        pmap = PMap().set("a", 1)
+        self.assertTrue(pmap.set("a", 1) is pmap)
+        self.assertTrue(pmap.delete("b") is pmap)
+        self.assertEqual(PMap().diff(PMap()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
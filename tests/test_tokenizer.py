@@ -0,0 +1,49 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDM"))
+
+from AutoTokenizer import scanBuffer, scanFile, tokenizeFile, tokenizeString
+
+EXAMPLE_WORLD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ExampleWorld")
+# Characters the tokenizers treat differently from plain text
+ALPHABET = 'ab_09 \t\n"#{}=,.<()'
+
+
+class TokenizerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "tokens.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compareFile(self, text):
+        with open(self.filename, "w") as f:
+            f.write(text)
+        self.assertEqual(list(tokenizeFile(self.filename)), scanFile(self.filename), repr(text))
+
+    def testExampleWorld(self):
+        for dirname, dirs, files in os.walk(EXAMPLE_WORLD):
+            for f in files:
+                filename = os.path.join(dirname, f)
+                self.assertEqual(list(tokenizeFile(filename)), scanFile(filename), filename)
+
+    def testRandomFiles(self):
+        rand = random.Random(0)
+        for i in range(2000):
+            self.compareFile("".join(rand.choice(ALPHABET) for j in range(rand.randint(0, 60))))
+
+    def testRandomStrings(self):
+        rand = random.Random(1)
+        for i in range(2000):
+            s = "".join(rand.choice(ALPHABET) for j in range(rand.randint(0, 60)))
+            self.assertEqual(list(tokenizeString(s)), scanBuffer(s, splitlines=False), repr(s))
+
+
+if __name__ == "__main__":
+    unittest.main()
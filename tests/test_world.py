@@ -0,0 +1,55 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AutoDM"))
+
+from DMParser import WorldParser
+from WorldGenerator import WorldGenerator
+
+
+def getPresent(world, nodename):
+    return set(c["NAME"] for c, name, desc in world.nodes[nodename].getActiveCharacters(world))
+
+
+class FastForwardTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        WorldGenerator(nodes=10, characters=100, rerun=0.3, depth=3, seed=5).generate(cls.dir)
+        cls.world = WorldParser(cls.dir).parse()
+        cls.world.addHour(7)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def testMatchesHourlySteps(self):
+        hours = 120
+        total = 0
+        for name in sorted(self.world.nodes):
+            events = self.world.fork().fastForward(hours, name)
+
+            stepped = self.world.fork()
+            expected = []
+            here = getPresent(stepped, name)
+            for i in range(hours):
+                stepped.addHour(1)
+                now = getPresent(stepped, name)
+                expected += [(stepped.hour, "arrive", n) for n in now-here]
+                expected += [(stepped.hour, "leave", n) for n in here-now]
+                here = now
+            self.assertEqual(sorted((h, e, n) for h, e, n, desc in events), sorted(expected), name)
+            total += len(events)
+        self.assertTrue(total>0)
+
+    def testAdvancesClock(self):
+        w = self.world.fork()
+        w.fastForward(30, sorted(w.nodes)[0])
+        self.assertEqual(w.hour, self.world.hour+30)
+
+
+if __name__ == "__main__":
+    unittest.main()